@@ -0,0 +1,132 @@
+"""Benchmark of booking latency while backup_db runs
+
+Creates a throwaway SQLite test database file with a long booking history and
+posts bookings through the booking view at a steady rate, first with no backup
+running, then during a one-shot backup and during the default stepped backup.
+
+Usage: python benchmarks/bench_backup.py [--history 300000] [--rate 20] [--journal wal]
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from io import StringIO
+from pathlib import Path
+
+import django
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "config.settings")
+django.setup()
+
+# pylint: disable=wrong-import-position
+from django.contrib.auth import get_user_model
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.test import Client
+from django.test.utils import setup_test_environment
+from django.urls import reverse
+from django.utils import timezone
+
+from pages.models import Appointment
+
+
+def populate(history, slots):
+    """Bulk inserts past bookings and future open slots"""
+    user = get_user_model().objects.create_user(username="bench", password="bench12345")
+    start = timezone.now() - timedelta(minutes=30 * history)
+    batch = []
+    for i in range(history):
+        slot = start + timedelta(minutes=30 * i)
+        batch.append(Appointment(start_date=slot, end_date=slot + timedelta(minutes=30),
+                                 user_id=user, msg_text="x" * 100))
+        if len(batch) == 10000:
+            Appointment.objects.bulk_create(batch)
+            batch.clear()
+    Appointment.objects.bulk_create(batch)
+    now = timezone.now()
+    for i in range(slots):
+        Appointment.objects.create(start_date=now + timedelta(days=1, minutes=30 * i))
+
+
+def book_while(running, booking, slots, rate):
+    """Books open slots at the given rate while running is set, returns latencies"""
+    client = Client()
+    client.login(username="bench", password="bench12345")
+    url = reverse("booking")
+    timings = []
+    while running.is_set():
+        began = time.perf_counter()
+        client.post(url, {"start_date_id": next(slots), "note": "bench"})
+        timings.append(time.perf_counter() - began)
+        booking.set()
+        time.sleep(max(0.0, 1 / rate - timings[-1]))
+    return timings
+
+
+def measure(name, slots, rate, action):
+    """Runs action while booking in another thread and prints the latencies"""
+    running, booking = threading.Event(), threading.Event()
+    running.set()
+    result = {}
+    worker = threading.Thread(
+        target=lambda: result.update(t=book_while(running, booking, slots, rate)))
+    worker.start()
+    booking.wait()
+    began = time.perf_counter()
+    try:
+        output = action()
+    except CommandError as error:
+        output = f"failed: {error}"
+    finally:
+        running.clear()
+        worker.join()
+    elapsed = time.perf_counter() - began
+    timings = sorted(result["t"])
+    print(f"{name:<16} {elapsed:6.1f} s  {len(timings):5d} bookings  "
+          f"median {statistics.median(timings) * 1000:7.1f} ms  "
+          f"p99 {timings[int(len(timings) * 0.99)] * 1000:7.1f} ms  "
+          f"max {timings[-1] * 1000:7.1f} ms  {output}")
+
+
+def main():
+    """Runs the benchmark and prints the timings"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--history", type=int, default=300000)
+    parser.add_argument("--rate", type=float, default=20, help="Bookings per second")
+    parser.add_argument("--journal", default="wal", choices=("wal", "delete"))
+    args = parser.parse_args()
+
+    setup_test_environment()
+    directory = tempfile.mkdtemp()
+    connection.settings_dict["TEST"]["NAME"] = os.path.join(directory, "bench.sqlite3")
+    connection.settings_dict["OPTIONS"] = {
+        "init_command": f"PRAGMA journal_mode={args.journal};"}
+    connection.creation.create_test_db(verbosity=0)
+    try:
+        began = time.perf_counter()
+        populate(args.history, 5000)
+        print(f"Inserted {args.history} bookings in {time.perf_counter() - began:.1f} s, "
+              f"database {os.path.getsize(connection.settings_dict['NAME']) >> 20} MB")
+        slots = iter(Appointment.objects.filter(user_id__isnull=True)
+                     .values_list("id", flat=True))
+
+        def backup(*options):
+            out = StringIO()
+            call_command("backup_db", os.path.join(directory, "backups"), *options, stdout=out)
+            return out.getvalue().split(", ")[-1].strip()
+
+        measure("no backup", slots, args.rate, lambda: time.sleep(3) or "")
+        measure("one-shot backup", slots, args.rate,
+                lambda: backup("--pages", "-1", "--sleep", "0"))
+        measure("stepped backup", slots, args.rate, backup)
+    finally:
+        connection.creation.destroy_test_db(connection.settings_dict["NAME"], verbosity=0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""Benchmark of the booking overlap check
+
+Creates a throwaway SQLite test database with hundreds of thousands of booked
+intervals and times Appointment.overlaps_booking().
+
+Usage: python benchmarks/bench_overlap.py [--intervals 300000] [--checks 2000]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import timedelta
+from pathlib import Path
+
+import django
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "config.settings")
+django.setup()
+
+# pylint: disable=wrong-import-position
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.utils import timezone
+
+from pages.models import Appointment, Resource
+
+
+def populate(intervals, resources):
+    """Bulk inserts back-to-back booked appointments of varying length"""
+    user = get_user_model().objects.create_user(username="bench")
+    stylists = Resource.objects.bulk_create(
+        Resource(name=f"Stylist {i}") for i in range(resources))
+    start = timezone.now()
+    batch = []
+    for i in range(intervals):
+        resource = stylists[i % resources]
+        slot = start + timedelta(minutes=30 * (i // resources))
+        duration = timedelta(minutes=random.choice((30, 30, 60, 90)))
+        batch.append(Appointment(start_date=slot, duration=duration, end_date=slot + duration,
+                                 resource=resource, user_id=user))
+        if len(batch) == 10000:
+            Appointment.objects.bulk_create(batch)
+            batch.clear()
+    Appointment.objects.bulk_create(batch)
+    return stylists, start
+
+
+def main():
+    """Runs the benchmark and prints the timings"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--intervals", type=int, default=300000)
+    parser.add_argument("--resources", type=int, default=10)
+    parser.add_argument("--checks", type=int, default=2000)
+    args = parser.parse_args()
+
+    connection.creation.create_test_db(verbosity=0)
+    try:
+        began = time.perf_counter()
+        stylists, start = populate(args.intervals, args.resources)
+        print(f"Inserted {args.intervals} intervals in {time.perf_counter() - began:.1f} s")
+
+        span = timedelta(minutes=30 * (args.intervals // args.resources))
+        candidates = []
+        for _ in range(args.checks):
+            slot = start + span * random.random()
+            candidates.append(Appointment(start_date=slot, end_date=slot + timedelta(minutes=45),
+                                          resource=stylists[random.randrange(args.resources)]))
+
+        timings = []
+        for candidate in candidates:
+            began = time.perf_counter()
+            candidate.overlaps_booking()
+            timings.append(time.perf_counter() - began)
+        timings.sort()
+        print(f"Overlap check over {args.checks} runs: "
+              f"median {timings[len(timings) // 2] * 1000:.3f} ms, "
+              f"p99 {timings[int(len(timings) * 0.99)] * 1000:.3f} ms")
+
+        with connection.cursor() as cursor:
+            sql, params = (Appointment.objects
+                           .overlapping(candidates[0].resource_id, candidates[0].start_date,
+                                        candidates[0].end_date)
+                           .query.sql_with_params())
+            cursor.execute(f"EXPLAIN QUERY PLAN {sql}", params)
+            for row in cursor.fetchall():
+                print("Plan:", row[-1])
+    finally:
+        connection.creation.destroy_test_db(connection.settings_dict["NAME"], verbosity=0)
+
+
+if __name__ == "__main__":
+    main()
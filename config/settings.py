@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.1/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -42,14 +43,33 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    # Picks the salon by subdomain or URL prefix
+    'pages.tenancy.SalonMiddleware',
+    # Sheds load on write-heavy views before they queue up for the write lock
+    'pages.middleware.ConcurrencyLimitMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    # Reports N+1 query patterns, only active when DEBUG is on
+    'pages.middleware.RepeatedQueryMiddleware',
 ]
 
+# Statement shapes repeated more often than this in one request are reported
+QUERY_REPEAT_THRESHOLD = 5
+
+# Requests let through at once per URL name, salon and worker process
+CONCURRENCY_LIMITS = {
+    "booking": 2,
+    "changepswd": 1,
+}
+# Further requests that may wait, how long they wait, and the Retry-After sent when shed
+CONCURRENCY_QUEUE_SIZE = 4
+CONCURRENCY_QUEUE_TIMEOUT = 1.0
+CONCURRENCY_RETRY_AFTER = 2
+
 ROOT_URLCONF = 'config.urls'
 
 TEMPLATES = [
@@ -74,14 +94,54 @@ WSGI_APPLICATION = 'config.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
 
+# WAL lets readers, like backup_db, work alongside a writer
+SQLITE_OPTIONS = {'init_command': 'PRAGMA journal_mode=WAL;'}
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        'OPTIONS': SQLITE_OPTIONS,
+    }
+}
+
+# Salons and the database holding their bookings. Users and sessions are shared
+# in default, which also holds the first salon. Further salons get their own
+# SQLite file, e.g. EXTRA_SALONS=viikki,otaniemi
+SALONS = {'kumpula': 'default'}
+for salon in filter(None, os.environ.get('EXTRA_SALONS', '').split(',')):
+    DATABASES[f'salon_{salon}'] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / f'salon_{salon}.sqlite3',
+        'OPTIONS': SQLITE_OPTIONS,
+    }
+    SALONS[salon] = f'salon_{salon}'
+
+DATABASE_ROUTERS = ['pages.tenancy.SalonRouter']
+
+# The dashboard cache is shared by every worker process, so a clear after an
+# archive run or an admin edit reaches all of them. The table is created with
+# 'manage.py createcachetable'
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'pages_cache',
     }
 }
 
 
+# Password hashing. The PBKDF2 iteration count is measured with
+# 'manage.py calibrate_hasher', Django's default is used when unset
+PASSWORD_ITERATIONS = int(os.environ.get('PASSWORD_ITERATIONS', 0)) or None
+
+PASSWORD_HASHERS = [
+    'pages.hashers.CalibratedPBKDF2PasswordHasher',
+    'django.contrib.auth.hashers.PBKDF2SHA1PasswordHasher',
+    'django.contrib.auth.hashers.Argon2PasswordHasher',
+    'django.contrib.auth.hashers.BCryptSHA256PasswordHasher',
+    'django.contrib.auth.hashers.ScryptPasswordHasher',
+]
+
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
 
@@ -124,14 +184,55 @@ STATIC_URL = 'static/'
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 
-# Default login address
-LOGIN_URL = '/login/'
+# Default login address, by URL name so it keeps the salon prefix
+LOGIN_URL = 'login'
 
 # Redirect after login
-LOGIN_REDIRECT_URL = '/'
+LOGIN_REDIRECT_URL = 'index'
 
 
 # Email settings
 
 EMAIL_BACKEND = "django.core.mail.backends.filebased.EmailBackend"
 EMAIL_FILE_PATH = BASE_DIR / "sent_emails"  # folder to save emails
+
+
+# Logging
+# https://docs.djangoproject.com/en/5.1/topics/logging/
+
+LOGGING = {
+    "version": 1,
+    "disable_existing_loggers": False,
+    "formatters": {
+        "json": {
+            "()": "pages.audit.JsonFormatter",
+        },
+    },
+    "handlers": {
+        "console": {
+            "class": "logging.StreamHandler",
+        },
+        "audit_file": {
+            "class": "pages.audit.QueuedRotatingFileHandler",
+            "filename": BASE_DIR / "logs" / "audit.log",
+            "formatter": "json",
+        },
+    },
+    "loggers": {
+        "pages.audit": {
+            "handlers": ["audit_file"],
+            "level": "INFO",
+            "propagate": False,
+        },
+        "pages.queries": {
+            "handlers": ["console"],
+            "level": "WARNING",
+            "propagate": False,
+        },
+        "pages.load": {
+            "handlers": ["console"],
+            "level": "WARNING",
+            "propagate": False,
+        },
+    },
+}
@@ -1,9 +1,110 @@
 """Module for admin pages"""
-from django.contrib import admin
+from django.contrib import admin, messages
+from django.db import transaction
+from django.db.models import Count
+from django.db.models.functions import TruncDate
+from django.utils import timezone
 
+from . import dashboard
+from .events import announce
+from .tenancy import salon_db
+
+
+from .models import (Appointment, ArchivedAppointment, DailyAvailability, Question, Answer,
+                     Resource, SlotEvent)
+
+
+class BookedFilter(admin.SimpleListFilter):
+    """Filter appointments by booking state without listing every user"""
+    title = "booking state"
+    parameter_name = "booked"
+
+    def lookups(self, request, model_admin):
+        return [("yes", "Booked"), ("no", "Open")]
+
+    def queryset(self, request, queryset):
+        if self.value() == "yes":
+            return queryset.filter(user_id__isnull=False)
+        if self.value() == "no":
+            return queryset.filter(user_id__isnull=True)
+        return queryset
+
+
+@admin.register(Resource)
+class ResourceAdmin(admin.ModelAdmin):
+    """Stylists and chairs"""
+    list_display = ("name", "kind", "active")
+    list_filter = ("kind", "active")
+    search_fields = ("name",)
+
+
+@admin.register(Appointment)
+class AppointmentAdmin(admin.ModelAdmin):
+    """Appointment admin which avoids per-row queries and full counts"""
+    list_display = ("id", "start_date", "end_date", "resource", "user_id", "book_date")
+    list_select_related = ("user_id", "resource")
+    list_filter = (BookedFilter, "resource")
+    date_hierarchy = "start_date"
+    ordering = ("-start_date",)
+    autocomplete_fields = ("user_id", "resource")
+    show_full_result_count = False
+    actions = ["release_slots", "delete_past_slots"]
+
+    @admin.action(description="Release selected slots", permissions=["change"])
+    def release_slots(self, request, queryset):
+        """Clears the booking of the selected slots with one UPDATE"""
+        with transaction.atomic(using=salon_db()):
+            per_day = list(queryset.filter(user_id__isnull=False)
+                           .annotate(day=TruncDate("start_date"))
+                           .values("day").annotate(released=Count("id"))
+                           .order_by())
+            freed = list(queryset.filter(user_id__isnull=False, start_date__gte=timezone.now())
+                         .select_related(None).only("id", "start_date", "resource_id"))
+            count = queryset.update(user_id=None, msg_text=None)
+            # update() sends no signals, open pages learn of the freed slots here
+            announce(SlotEvent.ADDED, freed, salon_db())
+            for row in per_day:
+                DailyAvailability.adjust(row["day"], open_delta=row["released"],
+                                         booked_delta=-row["released"])
+        if any(row["day"] < timezone.localdate() for row in per_day):
+            # Released past slots are in the cached history panels
+            dashboard.clear()
+        self.message_user(request, f"Released {count} slots.", messages.SUCCESS)
+
+    @admin.action(description="Delete selected past slots", permissions=["delete"])
+    def delete_past_slots(self, request, queryset):
+        """Deletes the selected slots that are in the past with one DELETE"""
+        count = queryset.filter(start_date__lt=timezone.now()).delete_counted()
+        # The deleted slots are in the cached history panels
+        dashboard.clear()
+        self.message_user(request, f"Deleted {count} past slots.", messages.SUCCESS)
+
+
+@admin.register(ArchivedAppointment)
+class ArchivedAppointmentAdmin(admin.ModelAdmin):
+    """Read mostly admin for archived appointments"""
+    list_display = ("id", "start_date", "resource", "user_id", "archived_date")
+    list_select_related = ("user_id", "resource")
+    date_hierarchy = "start_date"
+    ordering = ("-start_date",)
+    raw_id_fields = ("user_id", "resource")
+    show_full_result_count = False
+
+
+@admin.register(DailyAvailability)
+class DailyAvailabilityAdmin(admin.ModelAdmin):
+    """Read only view of the per-day slot counters"""
+    list_display = ("day", "open_count", "booked_count")
+    date_hierarchy = "day"
+    ordering = ("-day",)
+    show_full_result_count = False
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
 
-from .models import Appointment, Question, Answer
 
-admin.site.register(Appointment)
 admin.site.register(Question)
 admin.site.register(Answer)
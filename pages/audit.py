@@ -0,0 +1,78 @@
+"""Module for structured audit logging that writes to disk on a background thread"""
+import json
+import logging
+import queue
+from datetime import datetime, timezone
+from logging.handlers import QueueListener, RotatingFileHandler
+from pathlib import Path
+
+logger = logging.getLogger("pages.audit")
+
+
+def audit(request, event, **fields):
+    """Logs an audit event with the requesting user and address"""
+    user = getattr(request, "user", None)
+    fields.update({
+        "event": event,
+        "user": user.username if user is not None and user.is_authenticated else None,
+        "ip": request.META.get("REMOTE_ADDR"),
+        "salon": getattr(request, "salon", None),
+    })
+    logger.info(event, extra={"audit": fields})
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats a record as one JSON object per line"""
+
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        entry.update(getattr(record, "audit", {}))
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class QueuedRotatingFileHandler(logging.Handler):
+    """Puts records on a queue, a listener thread writes them to a rotating file
+
+    The request thread only appends to the queue; formatting and disk writes
+    happen on the listener thread, so a slow disk does not slow requests. A
+    plain Handler rather than a QueueHandler, which dictConfig configures
+    differently from Python 3.12 on.
+    """
+
+    def __init__(self, filename, max_bytes=10 * 1024 * 1024, backup_count=5):
+        super().__init__()
+        self.queue = queue.SimpleQueue()
+        Path(filename).parent.mkdir(parents=True, exist_ok=True)
+        self.file_handler = RotatingFileHandler(filename, maxBytes=max_bytes,
+                                                backupCount=backup_count,
+                                                encoding="utf-8", delay=True)
+        self.listener = QueueListener(self.queue, self.file_handler,
+                                      respect_handler_level=True)
+        self.listener.start()
+        self.stopped = False
+
+    def setFormatter(self, fmt):
+        # The file handler formats on the listener thread
+        self.file_handler.setFormatter(fmt)
+
+    def emit(self, record):
+        # Records stay in process, so they are queued without formatting or copying
+        try:
+            self.queue.put_nowait(record)
+        except Exception:  # pylint: disable=broad-exception-caught
+            self.handleError(record)
+
+    def close(self):
+        # Called by logging.shutdown() at exit, after which the queue is drained
+        if not self.stopped:
+            self.stopped = True
+            self.listener.stop()
+            self.file_handler.close()
+        super().close()
@@ -0,0 +1,149 @@
+"""Module for the staff utilization dashboard"""
+import calendar
+from datetime import datetime, time, timedelta
+
+from django.core.cache import cache
+from django.db.models import Count, DurationField, ExpressionWrapper, F, Q, Sum
+from django.db.models.functions import ExtractHour, ExtractIsoWeekDay, TruncDate
+from django.utils import timezone
+
+from .models import SALON_TIMEZONE, Appointment, ArchivedAppointment
+from .tenancy import current_salon
+
+# History before today is cached until the next day, today onwards briefly
+HISTORY_KEY = "pages:dashboard:{salon}:history"
+RECENT_KEY = "pages:dashboard:{salon}:recent"
+HISTORY_TIMEOUT = 7 * 24 * 60 * 60
+RECENT_TIMEOUT = 60
+# The archive has no stored report columns, they are computed like Appointment's
+ARCHIVE_COLUMNS = {
+    "local_date": TruncDate("start_date", tzinfo=SALON_TIMEZONE),
+    "local_weekday": ExtractIsoWeekDay("start_date", tzinfo=SALON_TIMEZONE),
+    "local_hour": ExtractHour("start_date", tzinfo=SALON_TIMEZONE),
+    "lead_time": ExpressionWrapper(F("start_date") - F("book_date"),
+                                   output_field=DurationField()),
+}
+
+
+def compute(since=None, until=None):
+    """Computes the panels for appointments starting in [since, until)
+
+    One grouped query per local day gives booked, open and lead time totals,
+    weeks and months are added up from the days. A second query groups
+    bookings by weekday and hour. Live appointments group on stored columns,
+    archived ones on the same expressions, and both tables are added up.
+    """
+    window = {}
+    if since is not None:
+        window["start_date__gte"] = since
+    if until is not None:
+        window["start_date__lt"] = until
+    return merge(panels(Appointment.objects.filter(**window)),
+                 panels(ArchivedAppointment.objects.annotate(**ARCHIVE_COLUMNS)
+                        .filter(**window)))
+
+
+def panels(slots):
+    """Computes the panels of one table's appointments"""
+    booked = Q(user_id__isnull=False)
+
+    days = (slots.values("local_date")
+            .annotate(booked=Count("id", filter=booked),
+                      open=Count("id", filter=~booked),
+                      lead=Sum("lead_time", filter=booked))
+            .order_by())
+    stats = {"daily": {}, "weekly": {}, "monthly": {}, "lead": {}}
+    for row in days:
+        day = row["local_date"]
+        counts = [row["booked"], row["open"]]
+        stats["daily"][day] = counts
+        for name, period in (("weekly", day - timedelta(days=day.weekday())),
+                             ("monthly", day.replace(day=1))):
+            total = stats[name].setdefault(period, [0, 0])
+            total[0] += counts[0]
+            total[1] += counts[1]
+        if row["booked"]:
+            lead = stats["lead"].setdefault(day.replace(day=1), [0.0, 0])
+            lead[0] += row["lead"].total_seconds()
+            lead[1] += row["booked"]
+
+    hours = (slots.filter(booked)
+             .values("local_weekday", "local_hour")
+             .annotate(count=Count("id"))
+             .order_by())
+    stats["peak"] = {(row["local_weekday"], row["local_hour"]): [row["count"]] for row in hours}
+    return stats
+
+
+def merge(*parts):
+    """Adds up panels computed over disjoint windows"""
+    merged = {}
+    for part in parts:
+        for panel, rows in part.items():
+            target = merged.setdefault(panel, {})
+            for key, values in rows.items():
+                if key in target:
+                    target[key] = [a + b for a, b in zip(target[key], values)]
+                else:
+                    target[key] = list(values)
+    return merged
+
+
+def history(boundary):
+    """Panels before the boundary, extended from the last cached boundary"""
+    key = HISTORY_KEY.format(salon=current_salon())
+    cached = cache.get(key)
+    if cached and cached["boundary"] == boundary:
+        return cached["stats"]
+    if (cached and cached["boundary"] < boundary
+            and boundary - cached["built"] < timedelta(seconds=HISTORY_TIMEOUT)):
+        # Only the days since the last refresh are queried
+        stats = merge(cached["stats"], compute(since=cached["boundary"], until=boundary))
+        built = cached["built"]
+    else:
+        # Rebuilt in full now and then, so changes nobody cleared for are picked up
+        stats = compute(until=boundary)
+        built = boundary
+    cache.set(key, {"boundary": boundary, "built": built, "stats": stats}, HISTORY_TIMEOUT)
+    return stats
+
+
+def recent(boundary):
+    """Panels from the boundary onwards, recomputed after a short timeout"""
+    key = RECENT_KEY.format(salon=current_salon())
+    cached = cache.get(key)
+    if cached and cached["boundary"] == boundary:
+        return cached["stats"]
+    stats = compute(since=boundary)
+    cache.set(key, {"boundary": boundary, "stats": stats}, RECENT_TIMEOUT)
+    return stats
+
+
+def clear(salon=None):
+    """Drops the cached panels of the given or active salon, e.g. after history was edited"""
+    salon = salon or current_salon()
+    cache.delete_many([HISTORY_KEY.format(salon=salon), RECENT_KEY.format(salon=salon)])
+
+
+def utilization():
+    """Returns all panels ready for the template"""
+    boundary = datetime.combine(timezone.localdate(), time(), tzinfo=timezone.get_current_timezone())
+    stats = merge(history(boundary), recent(boundary))
+
+    def periods(name):
+        return [{"period": key, "booked": booked, "open": open_,
+                 "utilization": round(100 * booked / (booked + open_)) if booked + open_ else 0}
+                for key, (booked, open_) in sorted(stats.get(name, {}).items())]
+
+    lead = [{"period": key, "days": round(total / count / 86400, 1), "count": count}
+            for key, (total, count) in sorted(stats.get("lead", {}).items())]
+    peak = sorted(({"weekday": calendar.day_abbr[weekday - 1], "hour": hour, "count": count}
+                   for (weekday, hour), (count,) in stats.get("peak", {}).items()),
+                  key=lambda row: -row["count"])
+    return {
+        "daily": periods("daily")[-60:],
+        "weekly": periods("weekly")[-26:],
+        "monthly": periods("monthly"),
+        "lead": lead,
+        "peak": peak[:10],
+    }
@@ -0,0 +1,149 @@
+"""Module for broadcasting slot availability changes to event stream listeners"""
+import asyncio
+import json
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.db import transaction
+from django.utils import timezone
+from django.utils.formats import date_format
+
+from .models import SlotEvent
+
+# Events older than this are pruned from the change log
+EVENT_RETENTION = timedelta(hours=1)
+# The change log is pruned whenever an event id is a multiple of this
+PRUNE_EVERY = 500
+
+
+def event_payload(event):
+    """Returns the event as a Server-Sent Events message"""
+    data = json.dumps({
+        "id": event.appointment_id,
+        "start": event.start_date.isoformat(),
+        "label": date_format(timezone.localtime(event.start_date), "d.m.Y H:i"),
+        "resource": event.resource_id,
+    })
+    return f"id: {event.id}\nevent: {event.kind}\ndata: {data}\n\n"
+
+
+def events_after(last_id, using, limit=500):
+    """Returns change log rows newer than last_id"""
+    return list(SlotEvent.objects.using(using).filter(id__gt=last_id).order_by("id")[:limit])
+
+
+def latest_event_id(using):
+    """Returns the id of the newest change log row"""
+    last = SlotEvent.objects.using(using).order_by("-id").values_list("id", flat=True).first()
+    return last or 0
+
+
+def prune_events(using):
+    """Deletes change log rows no listener needs any more"""
+    (SlotEvent.objects.using(using)
+     .filter(created__lt=timezone.now() - EVENT_RETENTION).delete())
+
+
+def log_events(kind, appointments, using):
+    """Adds a row per appointment to the change log, pruning old rows every PRUNE_EVERY events
+
+    Pruning here works under WSGI too, where no hub poller runs. Bulk writes
+    log their rows with one INSERT.
+    """
+    events = SlotEvent.objects.using(using).bulk_create(
+        SlotEvent(kind=kind, appointment_id=appointment.id, start_date=appointment.start_date,
+                  resource_id=appointment.resource_id)
+        for appointment in appointments)
+    # Some id in the batch is a multiple of PRUNE_EVERY
+    if events and (events[0].id - 1) // PRUNE_EVERY != events[-1].id // PRUNE_EVERY:
+        prune_events(using)
+    return events
+
+
+def announce(kind, appointments, using):
+    """Logs the slot changes and wakes this process's listeners after the commit
+
+    Listeners in other processes pick the rows up on their next poll.
+    """
+    events = log_events(kind, appointments, using)
+    if events:
+        transaction.on_commit(get_hub(using).notify, using=using)
+    return events
+
+
+class SlotEventHub:
+    """Per-process fan-out of one salon's change log to connected listeners
+
+    One poller task reads the change log for the whole process and puts the
+    messages on the listeners' queues, so an idle listener is just a queue.
+    The poller runs only while someone is listening.
+    """
+
+    def __init__(self, using="default", poll_interval=1.0, queue_size=100):
+        self.using = using
+        self.poll_interval = poll_interval
+        self.queue_size = queue_size
+        self.listeners = set()
+        self.loop = None
+        self.task = None
+        self.wakeup = None
+
+    def subscribe(self):
+        """Registers a listener and starts the poller if needed"""
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        self.listeners.add(queue)
+        loop = asyncio.get_running_loop()
+        if self.task is None or self.task.done() or self.loop is not loop:
+            self.loop = loop
+            self.wakeup = asyncio.Event()
+            self.task = loop.create_task(self.run())
+        return queue
+
+    def unsubscribe(self, queue):
+        """Removes a listener"""
+        self.listeners.discard(queue)
+
+    def is_subscribed(self, queue):
+        """Returns false once a listener has been dropped"""
+        return queue in self.listeners
+
+    def notify(self):
+        """Wakes the poller, callable from any thread after a local write"""
+        if self.loop is not None and self.wakeup is not None and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.wakeup.set)
+
+    def publish(self, message):
+        """Puts a message on every queue, dropping listeners that fall behind"""
+        for queue in list(self.listeners):
+            try:
+                queue.put_nowait(message)
+            except asyncio.QueueFull:
+                # The stream ends and the client catches up with Last-Event-ID
+                self.listeners.discard(queue)
+
+    async def run(self):
+        """Polls the change log while there are listeners"""
+        last_id = await sync_to_async(latest_event_id)(self.using)
+        polls = 0
+        while self.listeners:
+            for event in await sync_to_async(events_after)(last_id, self.using):
+                last_id = event.id
+                self.publish(event_payload(event))
+            polls += 1
+            if polls % 600 == 0:
+                await sync_to_async(prune_events)(self.using)
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+
+
+hubs = {}
+
+
+def get_hub(using):
+    """Returns the hub of a salon database"""
+    if using not in hubs:
+        hubs[using] = SlotEventHub(using)
+    return hubs[using]
@@ -0,0 +1,49 @@
+"""Module for per-user iCalendar feeds"""
+from datetime import timezone as dt_timezone
+
+from django.core import signing
+
+SALT = "pages.calendar"
+
+
+def calendar_token(user):
+    """Returns a signed token identifying the user's calendar feed"""
+    return signing.Signer(salt=SALT).sign(str(user.pk))
+
+
+def user_id_from_token(token):
+    """Returns the user id of a valid token, None otherwise"""
+    try:
+        return int(signing.Signer(salt=SALT).unsign(token))
+    except (signing.BadSignature, ValueError):
+        return None
+
+
+def escape_text(value):
+    """Escapes a TEXT value as required by RFC 5545"""
+    return (value.replace("\\", r"\\").replace(";", r"\;").replace(",", r"\,")
+            .replace("\r\n", r"\n").replace("\n", r"\n"))
+
+
+def format_utc(value):
+    """Formats an aware datetime as an iCalendar UTC timestamp"""
+    return value.astimezone(dt_timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+
+
+def ics_lines(appointments):
+    """Yields the calendar one line at a time"""
+    yield "BEGIN:VCALENDAR\r\n"
+    yield "VERSION:2.0\r\n"
+    yield "PRODID:-//KumpulaSalon//Booking//EN\r\n"
+    yield "X-WR-CALNAME:KumpulaSalon\r\n"
+    for appointment in appointments:
+        yield "BEGIN:VEVENT\r\n"
+        yield f"UID:appointment-{appointment.id}@kumpulasalon\r\n"
+        yield f"DTSTAMP:{format_utc(appointment.book_date)}\r\n"
+        yield f"DTSTART:{format_utc(appointment.start_date)}\r\n"
+        yield f"DTEND:{format_utc(appointment.end_date)}\r\n"
+        yield "SUMMARY:KumpulaSalon appointment\r\n"
+        if appointment.msg_text:
+            yield f"DESCRIPTION:{escape_text(appointment.msg_text)}\r\n"
+        yield "END:VEVENT\r\n"
+    yield "END:VCALENDAR\r\n"
@@ -0,0 +1,21 @@
+"""Module for the password hasher tuned to this machine"""
+from django.conf import settings
+from django.contrib.auth.hashers import PBKDF2PasswordHasher
+
+# No calibration goes below this, OWASP's 2023 floor for PBKDF2-HMAC-SHA256
+MIN_ITERATIONS = 600_000
+
+
+class CalibratedPBKDF2PasswordHasher(PBKDF2PasswordHasher):
+    """PBKDF2 with the iteration count chosen by calibrate_hasher
+
+    Keeps Django's algorithm name, so existing hashes still verify and are
+    rehashed with the configured count on the user's next login.
+    """
+
+    @property
+    def iterations(self):
+        configured = getattr(settings, "PASSWORD_ITERATIONS", None)
+        if not configured:
+            return PBKDF2PasswordHasher.iterations
+        return max(configured, MIN_ITERATIONS)
@@ -0,0 +1,143 @@
+"""Module for replaying POST responses that are retried with an Idempotency-Key"""
+import zlib
+from datetime import timedelta
+from functools import wraps
+
+from django.contrib import messages
+from django.db import IntegrityError, transaction
+from django.http import HttpResponse
+from django.utils import timezone
+
+from .models import IdempotencyKey
+from .tenancy import salon_db
+
+# How long a stored response is replayed
+IDEMPOTENCY_TTL = timedelta(hours=24)
+# A request still running after this long is taken as crashed, its key can be reused
+IN_PROGRESS_LEASE = timedelta(seconds=30)
+# Expired keys are purged at most this often per process and database
+PURGE_INTERVAL = timedelta(minutes=10)
+# Larger bodies are not stored, the replay then has only status and headers
+MAX_STORED_BODY = 64 * 1024
+FORM_FIELD = "idempotency_key"
+
+
+def request_key(request):
+    """Returns the key from the header or the form field, None if missing or invalid"""
+    key = request.headers.get("Idempotency-Key") or request.POST.get(FORM_FIELD)
+    if not key or len(key) > IdempotencyKey._meta.get_field("key").max_length:
+        return None
+    return key
+
+
+def message_count(request):
+    """Returns the number of messages before the view runs"""
+    return len(messages.get_messages(request))
+
+
+def added_messages(request, count_before):
+    """Returns the messages added by the view, keeping all of them for display"""
+    # Reading the storage marks every message as shown, so they are added again
+    current = list(messages.get_messages(request))
+    for message in current:
+        messages.add_message(request, message.level, message.message,
+                             extra_tags=message.extra_tags)
+    return [[m.level, m.message, m.extra_tags] for m in current[count_before:]]
+
+
+_last_purge = {}
+
+
+def purge_expired(using, now):
+    """Deletes expired keys, skipped when this process purged recently"""
+    last = _last_purge.get(using)
+    if last is not None and now - last < PURGE_INTERVAL:
+        return
+    _last_purge[using] = now
+    IdempotencyKey.objects.using(using).filter(created__lt=now - IDEMPOTENCY_TTL).delete()
+
+
+def claim(lookup, owner, now):
+    """Returns a new marker for the key, or None and the row of an earlier request
+
+    An expired row, or an in-progress one whose request has crashed, is taken
+    over. The update is conditional, so only one retry gets it.
+    """
+    try:
+        with transaction.atomic(using=salon_db()):
+            return IdempotencyKey.objects.create(owner=owner, **lookup), None
+    except IntegrityError:
+        stored = IdempotencyKey.objects.get(**lookup)
+    expired = stored.created < now - IDEMPOTENCY_TTL
+    abandoned = (stored.status_code is None and stored.created < now - IN_PROGRESS_LEASE
+                 and (not owner or not stored.owner or owner == stored.owner))
+    if not (expired or abandoned):
+        return None, stored
+    fresh = {"owner": owner, "created": now, "status_code": None, "location": "",
+             "content_type": "", "body": b"", "stored_messages": []}
+    if not (IdempotencyKey.objects.filter(pk=stored.pk, created=stored.created)
+            .update(**fresh)):
+        return None, IdempotencyKey.objects.get(**lookup)
+    for name, value in fresh.items():
+        setattr(stored, name, value)
+    return stored, None
+
+
+def replay(request, stored):
+    """Rebuilds the stored response"""
+    response = HttpResponse(zlib.decompress(stored.body) if stored.body else b"",
+                            status=stored.status_code,
+                            content_type=stored.content_type or None)
+    if stored.location:
+        response["Location"] = stored.location
+    response["Idempotent-Replayed"] = "true"
+    for level, message, extra_tags in stored.stored_messages:
+        messages.add_message(request, level, message, extra_tags=extra_tags)
+    return response
+
+
+def idempotent(view):
+    """Runs a POST view once per Idempotency-Key and replays its response on retries"""
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        key = request_key(request) if request.method == "POST" else None
+        if key is None:
+            return view(request, *args, **kwargs)
+
+        # A password change logs the user out, so the key is not scoped by
+        # user; the owner only stops another logged in user from replaying
+        lookup = {"scope": view.__name__, "key": key}
+        owner = str(request.user.pk) if request.user.is_authenticated else ""
+        now = timezone.now()
+        purge_expired(salon_db(), now)
+        marker, stored = claim(lookup, owner, now)
+        if marker is None:
+            if owner and stored.owner and owner != stored.owner:
+                return HttpResponse("Idempotency key belongs to another user", status=422)
+            if stored.status_code is None:
+                # The first request is still running
+                response = HttpResponse("Request with this key is in progress", status=409)
+                response["Retry-After"] = "1"
+                return response
+            return replay(request, stored)
+
+        count_before = message_count(request)
+        try:
+            response = view(request, *args, **kwargs)
+        except Exception:
+            marker.delete()
+            raise
+
+        if response.streaming or response.status_code >= 500:
+            marker.delete()
+            return response
+        marker.status_code = response.status_code
+        marker.location = response.get("Location", "")
+        marker.content_type = response.get("Content-Type", "")
+        if len(response.content) <= MAX_STORED_BODY:
+            marker.body = zlib.compress(response.content)
+        marker.stored_messages = added_messages(request, count_before)
+        marker.save(update_fields=["status_code", "location", "content_type", "body",
+                                   "stored_messages"])
+        return response
+    return wrapper
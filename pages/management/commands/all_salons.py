@@ -0,0 +1,36 @@
+"""Command for running another management command in every salon"""
+import argparse
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+
+from pages.tenancy import salons, use_salon
+
+
+class Command(BaseCommand):
+    """Runs a command once per salon with that salon's database active"""
+    help = ("Run a management command in every salon, e.g. "
+            "'all_salons migrate' or 'all_salons archive_appointments --days 30'")
+
+    def add_arguments(self, parser):
+        parser.add_argument("command", help="Name of the command to run")
+        parser.add_argument("args", nargs=argparse.REMAINDER,
+                            help="Arguments passed to the command")
+
+    def handle(self, *args, **options):
+        command = options["command"]
+        if command == "migrate":
+            # Shared apps live in default, which is migrated first
+            self.stdout.write(self.style.MIGRATE_HEADING("Database default"))
+            call_command("migrate", *args, database="default")
+            for salon, alias in salons().items():
+                if alias != "default":
+                    self.stdout.write(self.style.MIGRATE_HEADING(f"Salon {salon}"))
+                    with use_salon(salon):
+                        call_command("migrate", *args, database=alias)
+            return
+
+        for salon in salons():
+            self.stdout.write(self.style.MIGRATE_HEADING(f"Salon {salon}"))
+            with use_salon(salon):
+                call_command(command, *args)
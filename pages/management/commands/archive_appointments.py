@@ -0,0 +1,56 @@
+"""Command for moving past appointments to the archive table"""
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from pages import dashboard
+from pages.models import Appointment, ArchivedAppointment
+from pages.tenancy import salon_db
+
+
+class Command(BaseCommand):
+    """Moves appointments older than a cutoff to ArchivedAppointment in batches"""
+    help = "Archive appointments older than the given number of days"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--days", type=int, default=30,
+                            help="Archive appointments that started this many days ago")
+        parser.add_argument("--batch-size", type=int, default=500,
+                            help="Rows moved per transaction")
+        parser.add_argument("--sleep", type=float, default=0.05,
+                            help="Seconds to pause between batches")
+
+    def handle(self, *args, **options):
+        if options["batch_size"] < 1:
+            raise CommandError("--batch-size must be at least 1")
+        cutoff = timezone.now() - timedelta(days=options["days"])
+
+        moved = 0
+        while True:
+            count = self.archive_batch(cutoff, options["batch_size"])
+            if count == 0:
+                break
+            moved += count
+            # Give other writers a chance at the database lock
+            time.sleep(options["sleep"])
+
+        if moved:
+            dashboard.clear()
+        self.stdout.write(self.style.SUCCESS(f"Archived {moved} appointments"))
+
+    @staticmethod
+    def archive_batch(cutoff, batch_size):
+        """Moves one batch in a short transaction, returns the number of rows moved"""
+        with transaction.atomic(using=salon_db()):
+            batch = list(Appointment.objects
+                         .filter(start_date__lt=cutoff)
+                         .order_by("start_date")[:batch_size])
+            if not batch:
+                return 0
+            ArchivedAppointment.objects.bulk_create(
+                [ArchivedAppointment.from_appointment(a) for a in batch])
+            Appointment.objects.filter(id__in=[a.id for a in batch]).delete_counted()
+        return len(batch)
@@ -0,0 +1,142 @@
+"""Command for backing up a salon database while the site is running"""
+import gzip
+import shutil
+import sqlite3
+import time
+from contextlib import ExitStack
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+from django.utils import timezone
+
+from pages.tenancy import salon_db
+
+# Compressed output is written in chunks of this many bytes
+CHUNK_SIZE = 1024 * 1024
+# SQLITE_BUSY and SQLITE_LOCKED step results, the step is retried after a pause
+LOCKED_STATUSES = {5, 6}
+# Give up when the source stays locked by a writer this many seconds
+LOCKED_TIMEOUT = 30
+
+
+def copy_database(source, path, pages, sleep, max_restarts):
+    """Copies an open SQLite connection into a file a few pages at a time
+
+    Each step holds the source's read lock only while it copies its pages, and
+    the pause after it lets writers commit. SQLite restarts the copy when
+    another connection writes during it, unless the source is reading a WAL
+    snapshot; returns the number of restarts.
+    """
+    state = {"remaining": None, "restarts": 0, "locked_since": None}
+
+    def progress(status, remaining, total):
+        # pylint: disable=unused-argument
+        if status in LOCKED_STATUSES:
+            state["locked_since"] = state["locked_since"] or time.monotonic()
+            if time.monotonic() - state["locked_since"] > LOCKED_TIMEOUT:
+                raise CommandError(f"Database stayed locked for {LOCKED_TIMEOUT} s")
+            return
+        state["locked_since"] = None
+        if state["remaining"] is not None and remaining > state["remaining"]:
+            state["restarts"] += 1
+            if state["restarts"] > max_restarts:
+                raise CommandError(f"Copy restarted {state['restarts']} times because of "
+                                   "concurrent writes, use WAL mode or a larger --pages")
+        state["remaining"] = remaining
+        if remaining and sleep:
+            time.sleep(sleep)
+
+    target = sqlite3.connect(path)
+    try:
+        source.backup(target, pages=pages, progress=progress)
+    finally:
+        target.close()
+    return state["restarts"]
+
+
+def check_integrity(path):
+    """Raises CommandError unless PRAGMA integrity_check passes on the file"""
+    checked = sqlite3.connect(path)
+    try:
+        problems = [row[0] for row in checked.execute("PRAGMA integrity_check")]
+    except sqlite3.DatabaseError as error:
+        problems = [str(error)]
+    finally:
+        checked.close()
+    if problems != ["ok"]:
+        raise CommandError(f"Backup {path} failed integrity check: {'; '.join(problems[:5])}")
+
+
+class Command(BaseCommand):
+    """Backs up the active salon's SQLite database without blocking bookings"""
+    help = ("Copy the active salon's database in small steps so writes continue, "
+            "e.g. 'backup_db backups/ --compress --verify'")
+
+    def add_arguments(self, parser):
+        parser.add_argument("output", nargs="?", default=str(settings.BASE_DIR / "backups"),
+                            help="Backup file, or directory for a timestamped file")
+        parser.add_argument("--database", help="Database alias, defaults to the active salon's")
+        parser.add_argument("--pages", type=int, default=64,
+                            help="Pages copied per step, -1 copies everything at once")
+        parser.add_argument("--sleep", type=float, default=0.05,
+                            help="Seconds to pause between steps")
+        parser.add_argument("--max-restarts", type=int, default=20,
+                            help="Give up when writes restart the copy more often")
+        parser.add_argument("--compress", action="store_true",
+                            help="Write a gzip file")
+        parser.add_argument("--verify", action="store_true",
+                            help="Run PRAGMA integrity_check on the copy")
+
+    def target_path(self, output, alias, compress):
+        """Returns the output file, naming it when a directory is given"""
+        path = Path(output)
+        if not path.suffix:
+            path = path / f"{alias}-{timezone.now():%Y%m%d-%H%M%S}.sqlite3"
+        if compress and path.suffix != ".gz":
+            path = path.with_name(path.name + ".gz")
+        return path
+
+    def handle(self, *args, **options):
+        alias = options["database"] or salon_db()
+        if alias not in connections:
+            raise CommandError(f"Unknown database {alias}")
+        connection = connections[alias]
+        if connection.vendor != "sqlite":
+            raise CommandError(f"Database {alias} is not SQLite")
+
+        path = self.target_path(options["output"], alias, options["compress"])
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Copy next to the target and rename, so a backup file is never partial
+        copy = path.with_name(path.name + ".part")
+        packed = path.with_name(path.name + ".gz.part")
+
+        began = time.perf_counter()
+        with connection.cursor() as cursor:
+            cursor.execute("PRAGMA journal_mode")
+            wal = cursor.fetchone()[0] == "wal"
+        try:
+            with ExitStack() as stack:
+                if wal:
+                    # Copy one snapshot, WAL readers don't hold up writers
+                    stack.enter_context(transaction.atomic(using=alias))
+                    with connection.cursor() as cursor:
+                        cursor.execute("SELECT COUNT(*) FROM sqlite_master")
+                restarts = copy_database(connection.connection, copy, options["pages"],
+                                         options["sleep"], options["max_restarts"])
+            if options["verify"]:
+                check_integrity(copy)
+            if options["compress"]:
+                with open(copy, "rb") as source, gzip.open(packed, "wb") as target:
+                    shutil.copyfileobj(source, target, CHUNK_SIZE)
+                packed.replace(path)
+            else:
+                copy.replace(path)
+        finally:
+            copy.unlink(missing_ok=True)
+            packed.unlink(missing_ok=True)
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Backed up {alias} to {path} ({path.stat().st_size} bytes) "
+            f"in {time.perf_counter() - began:.1f} s, {restarts} restarts"))
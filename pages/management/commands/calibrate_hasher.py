@@ -0,0 +1,77 @@
+"""Command for tuning the password hashing cost to this machine"""
+import statistics
+import time
+
+from django.conf import settings
+from django.contrib.auth.hashers import get_hashers
+from django.core.management.base import BaseCommand, CommandError
+
+from pages.hashers import MIN_ITERATIONS, CalibratedPBKDF2PasswordHasher
+
+# Iteration count of the short runs used to measure the cost of one iteration
+PROBE_ITERATIONS = 100_000
+# Recommended counts are rounded down to a multiple of this
+ROUND_TO = 10_000
+
+
+def time_encode(hasher, samples, **kwargs):
+    """Returns the median seconds one password hash takes"""
+    salt = hasher.salt()
+    timings = []
+    for _ in range(samples):
+        began = time.perf_counter()
+        hasher.encode("calibration password", salt, **kwargs)
+        timings.append(time.perf_counter() - began)
+    return statistics.median(timings)
+
+
+class Command(BaseCommand):
+    """Benchmarks the password hashers and recommends PASSWORD_ITERATIONS"""
+    help = ("Measure password hashing on this machine and recommend the PBKDF2 "
+            "iteration count that fits a login latency budget")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--target-ms", type=float, default=100,
+                            help="Hashing time per login to aim for")
+        parser.add_argument("--min-iterations", type=int, default=MIN_ITERATIONS,
+                            help=f"Never recommend fewer iterations than this, at least {MIN_ITERATIONS}")
+        parser.add_argument("--samples", type=int, default=5,
+                            help="Hashes timed per measurement")
+
+    def handle(self, *args, **options):
+        samples = options["samples"]
+        if samples < 1 or options["target_ms"] <= 0:
+            raise CommandError("--samples and --target-ms must be positive")
+        if options["min_iterations"] < MIN_ITERATIONS:
+            # The hasher never goes below its floor, so a lower count would not apply
+            raise CommandError(f"--min-iterations cannot be below {MIN_ITERATIONS}")
+
+        self.stdout.write("Hashers with their current settings:")
+        for hasher in get_hashers():
+            try:
+                seconds = time_encode(hasher, samples)
+            except ValueError:
+                # The hasher's library is not installed
+                self.stdout.write(f"  {hasher.algorithm:<22} not installed")
+                continue
+            self.stdout.write(f"  {hasher.algorithm:<22} {seconds * 1000:8.1f} ms")
+
+        hasher = CalibratedPBKDF2PasswordHasher()
+        per_iteration = time_encode(hasher, samples, iterations=PROBE_ITERATIONS) / PROBE_ITERATIONS
+        fitting = int(options["target_ms"] / 1000 / per_iteration) // ROUND_TO * ROUND_TO
+        iterations = max(fitting, options["min_iterations"])
+        seconds = time_encode(hasher, samples, iterations=iterations)
+
+        self.stdout.write(f"PBKDF2 at {iterations} iterations takes {seconds * 1000:.1f} ms")
+        if fitting < options["min_iterations"]:
+            self.stdout.write(self.style.WARNING(
+                f"{options['target_ms']:g} ms only fits {fitting} iterations, below the "
+                f"floor of {options['min_iterations']}. Raise the budget or use a "
+                "memory-hard hasher such as scrypt or Argon2."))
+        current = getattr(settings, "PASSWORD_ITERATIONS", None)
+        if current == iterations:
+            self.stdout.write(self.style.SUCCESS("PASSWORD_ITERATIONS is already set to this"))
+            return
+        self.stdout.write(self.style.SUCCESS(
+            f"Set PASSWORD_ITERATIONS={iterations} in the environment. Existing passwords "
+            "are rehashed with it on each user's next login."))
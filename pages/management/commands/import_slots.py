@@ -0,0 +1,156 @@
+"""Command for importing appointment slots from CSV or iCalendar files"""
+import csv
+from collections import Counter
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from pages.events import announce
+from pages.management.inputs import open_input
+from pages.models import Appointment, DailyAvailability, Resource, SlotEvent, MAX_DURATION
+from pages.tenancy import salon_db
+
+
+def parse_csv(lines):
+    """Yields (line number, start_date or None) from CSV with a start_date column"""
+    reader = csv.DictReader(lines)
+    if not reader.fieldnames or "start_date" not in reader.fieldnames:
+        raise CommandError("CSV input needs a start_date column")
+    for row in reader:
+        try:
+            value = parse_datetime((row["start_date"] or "").strip())
+        except ValueError:
+            # Well formed but out of range, e.g. month 13
+            value = None
+        if value is not None and timezone.is_naive(value):
+            value = timezone.make_aware(value)
+        yield reader.line_num, value
+
+
+def parse_ics_datetime(line):
+    """Returns an aware datetime from a DTSTART line, or None if invalid"""
+    name, _, value = line.partition(":")
+    params = dict(p.split("=", 1) for p in name.split(";")[1:] if "=" in p)
+    value = value.strip()
+    try:
+        if value.endswith("Z"):
+            return datetime.strptime(value, "%Y%m%dT%H%M%SZ").replace(tzinfo=ZoneInfo("UTC"))
+        naive = datetime.strptime(value, "%Y%m%dT%H%M%S")
+        if "TZID" in params:
+            return naive.replace(tzinfo=ZoneInfo(params["TZID"]))
+        return timezone.make_aware(naive)
+    except (ValueError, ZoneInfoNotFoundError):
+        return None
+
+
+def parse_ics(lines):
+    """Yields (line number, start_date or None) for every VEVENT DTSTART"""
+    in_event = False
+    for number, line in enumerate(lines, start=1):
+        line = line.rstrip("\r\n")
+        if line == "BEGIN:VEVENT":
+            in_event = True
+        elif line == "END:VEVENT":
+            in_event = False
+        elif in_event and line.startswith("DTSTART"):
+            yield number, parse_ics_datetime(line)
+
+
+class Command(BaseCommand):
+    """Streams slots from a file and inserts the new ones in batches"""
+    help = "Import open appointment slots from a CSV or .ics file"
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="CSV or .ics file, or - for stdin")
+        parser.add_argument("--format", choices=["csv", "ics"],
+                            help="Input format, guessed from the file name by default")
+        parser.add_argument("--resource",
+                            help="Name of the stylist or chair the slots belong to")
+        parser.add_argument("--duration", type=int, default=30,
+                            help="Length of each slot in minutes")
+        parser.add_argument("--batch-size", type=int, default=1000,
+                            help="Rows inserted per bulk_create")
+
+    def handle(self, *args, **options):
+        path = options["path"]
+        fmt = options["format"] or ("ics" if path.lower().endswith(".ics") else "csv")
+        batch_size = options["batch_size"]
+        if batch_size < 1:
+            raise CommandError("--batch-size must be at least 1")
+        duration = timedelta(minutes=options["duration"])
+        if not timedelta(0) < duration <= MAX_DURATION:
+            raise CommandError(f"--duration must be between 1 and "
+                               f"{MAX_DURATION // timedelta(minutes=1)} minutes")
+
+        resource = None
+        if options["resource"]:
+            try:
+                resource = Resource.objects.get(name=options["resource"])
+            except Resource.DoesNotExist as error:
+                raise CommandError(f"Unknown resource {options['resource']}") from error
+
+        # One query, then duplicate checks are set lookups
+        seen = set(Appointment.objects.filter(resource=resource)
+                   .values_list("start_date", flat=True))
+        now = timezone.now()
+        batch = []
+        created = skipped = invalid = queued = 0
+
+        parse = parse_ics if fmt == "ics" else parse_csv
+        with open_input(path) as lines:
+            for number, start_date in parse(lines):
+                if start_date is None or start_date <= now:
+                    invalid += 1
+                    self.stderr.write(f"Line {number}: invalid or past date, skipped")
+                    continue
+                if start_date in seen:
+                    skipped += 1
+                    continue
+                seen.add(start_date)
+                # bulk_create skips save(), so end_date is set here
+                batch.append(Appointment(start_date=start_date, resource=resource,
+                                         duration=duration,
+                                         end_date=start_date + duration))
+                queued += 1
+                if len(batch) >= batch_size:
+                    created += self.flush(batch, resource)
+            created += self.flush(batch, resource)
+        # Queued slots someone else added meanwhile were not inserted
+        skipped += queued - created
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Imported {created} slots, {skipped} duplicates, {invalid} invalid"))
+
+    @staticmethod
+    def flush(batch, resource):
+        """Inserts the pending slots that don't exist yet and their day counters
+
+        Empties the batch and returns the number of slots inserted.
+        """
+        if not batch:
+            return 0
+        with transaction.atomic(using=salon_db()):
+            # Slots added by someone else since the import started are left out,
+            # so neither the count nor the day counters include them
+            taken = set(Appointment.objects
+                        .filter(resource=resource,
+                                start_date__in=[a.start_date for a in batch])
+                        .values_list("start_date", flat=True))
+            new = [a for a in batch if a.start_date not in taken]
+            Appointment.objects.bulk_create(new, ignore_conflicts=True)
+            # ignore_conflicts leaves the ids unset, open pages need them
+            announce(SlotEvent.ADDED,
+                     Appointment.objects.filter(resource=resource,
+                                                start_date__in=[a.start_date for a in new],
+                                                start_date__gte=timezone.now())
+                     .only("id", "start_date", "resource_id"),
+                     salon_db())
+            per_day = Counter(timezone.localdate(a.start_date) for a in new)
+            for day, added in per_day.items():
+                DailyAvailability.adjust(day, open_delta=added)
+        batch.clear()
+        return len(new)
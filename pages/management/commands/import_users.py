@@ -0,0 +1,220 @@
+"""Command for importing customer accounts from CSV, JSON or JSON Lines files"""
+import csv
+import json
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+import django
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DatabaseError, transaction
+
+from pages.management.inputs import open_input
+from pages.models import Answer, Question
+from pages.tenancy import salon_db
+
+User = get_user_model()
+
+# Optional account fields read from the input
+USER_FIELDS = ("email", "first_name", "last_name")
+# Characters of a JSON array file read at a time
+JSON_CHUNK_SIZE = 64 * 1024
+WHITESPACE = re.compile(r"\s*")
+
+
+def parse_csv(lines):
+    """Yields (line number, row) from CSV with a header line"""
+    reader = csv.DictReader(lines)
+    if not reader.fieldnames or "username" not in reader.fieldnames:
+        raise CommandError("CSV input needs a username column")
+    for row in reader:
+        yield reader.line_num, row
+
+
+def parse_jsonl(lines):
+    """Yields (line number, row) from JSON Lines, one object per line"""
+    for number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            row = None
+        if not isinstance(row, dict):
+            raise CommandError(f"Line {number}: JSON input needs one object per line")
+        yield number, row
+
+
+def parse_json(stream):
+    """Yields (line number, row) from a JSON array of objects, one object at a time
+
+    The file is read in chunks and each object is decoded as soon as it is
+    complete, so a large array is never loaded whole.
+    """
+    decoder = json.JSONDecoder()
+    buffer, pos, line, expect = "", 0, 1, "["
+    while True:
+        end = WHITESPACE.match(buffer, pos).end()
+        line += buffer.count("\n", pos, end)
+        pos = end
+        if pos == len(buffer):
+            buffer, pos = stream.read(JSON_CHUNK_SIZE), 0
+            if not buffer:
+                raise CommandError(f"Line {line}: JSON input ends before the closing ]")
+            continue
+        char = buffer[pos]
+        if expect == "[":
+            if char != "[":
+                raise CommandError("JSON input needs an array of objects, "
+                                   "use --format jsonl for one object per line")
+            pos, expect = pos + 1, "first"
+        elif char == "]" and expect in ("first", ","):
+            return
+        elif expect == ",":
+            if char != ",":
+                raise CommandError(f"Line {line}: expected , or ] in the JSON array")
+            pos, expect = pos + 1, "object"
+        elif char != "{":
+            raise CommandError(f"Line {line}: JSON input needs an array of objects")
+        else:
+            try:
+                row, end = decoder.raw_decode(buffer, pos)
+            except ValueError as error:
+                # The object may continue in the next chunk
+                more = stream.read(JSON_CHUNK_SIZE)
+                if not more:
+                    raise CommandError(f"Line {line}: invalid JSON, {error.msg}") from error
+                buffer, pos = buffer[pos:] + more, 0
+                continue
+            yield line, row
+            line += buffer.count("\n", pos, end)
+            pos, expect = end, ","
+
+
+def hash_password(password):
+    """Hashes one password, run in the worker processes"""
+    # Blank passwords get an unusable one, the customer resets it
+    return make_password(password or None)
+
+
+class Command(BaseCommand):
+    """Streams customer rows and inserts them in batches, hashing in parallel"""
+    help = ("Import customer accounts, and optional recovery question answers, "
+            "from a CSV, JSON array or JSON Lines file. Accounts without a password get an "
+            "unusable one. Answers are saved in the salon's database after their "
+            "users are committed; answers that fail are reported, not rolled back "
+            "with the users")
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="CSV, .json or .jsonl file, or - for stdin")
+        parser.add_argument("--format", choices=["csv", "json", "jsonl"],
+                            help="Input format, guessed from the file name by default")
+        parser.add_argument("--batch-size", type=int, default=500,
+                            help="Rows hashed and inserted together")
+        parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                            help="Processes hashing passwords")
+
+    def handle(self, *args, **options):
+        path = options["path"]
+        suffix = os.path.splitext(path.lower())[1]
+        fmt = options["format"] or {".json": "json", ".jsonl": "jsonl"}.get(suffix, "csv")
+        batch_size = options["batch_size"]
+        workers = options["workers"]
+        if batch_size < 1 or workers < 1:
+            raise CommandError("--batch-size and --workers must be at least 1")
+
+        questions = {question.text: question for question in Question.objects.all()}
+        counts = {"created": 0, "answers": 0, "existing": 0, "invalid": 0,
+                  "no_password": 0, "failed_answers": 0}
+        began = time.perf_counter()
+
+        parse = {"csv": parse_csv, "json": parse_json, "jsonl": parse_jsonl}[fmt]
+        with open_input(path) as lines, \
+                ProcessPoolExecutor(workers, initializer=django.setup) as executor:
+            rows = self.valid_rows(parse(lines), questions, counts)
+            pending = None
+            # Hash the next batch in the workers while the previous one is inserted
+            while batch := list(islice(rows, batch_size)):
+                batch = self.new_rows(batch, counts)
+                hashes = executor.map(hash_password, [row.get("password") for row in batch],
+                                      chunksize=max(1, len(batch) // (workers * 4)))
+                if pending:
+                    self.flush(*pending, questions, counts, self.stderr)
+                pending = batch, hashes
+            if pending:
+                self.flush(*pending, questions, counts, self.stderr)
+
+        elapsed = time.perf_counter() - began
+        total = sum(counts[name] for name in ("created", "existing", "invalid"))
+        self.stdout.write(self.style.SUCCESS(
+            f"Imported {counts['created']} users and {counts['answers']} recovery answers, "
+            f"{counts['existing']} existing, {counts['invalid']} invalid, "
+            f"{counts['no_password']} without a password, "
+            f"{counts['failed_answers']} answers failed, in {elapsed:.1f} s "
+            f"({total / elapsed if elapsed else 0:.0f} rows/s)"))
+
+    def valid_rows(self, parsed, questions, counts):
+        """Yields the rows worth importing, reports the rest"""
+        seen = set()
+        for number, row in parsed:
+            username = (row.get("username") or "").strip()
+            question = row.get("question") or None
+            if not username or len(username) > 150:
+                problem = "missing or too long username"
+            elif question is not None and question not in questions:
+                problem = f"unknown question {question}"
+            elif question is not None and not row.get("answer"):
+                problem = "question without an answer"
+            elif username in seen:
+                problem = "duplicate username"
+            else:
+                seen.add(username)
+                row["username"] = username
+                yield row
+                continue
+            counts["invalid"] += 1
+            self.stderr.write(f"Line {number}: {problem}, skipped")
+
+    @staticmethod
+    def new_rows(batch, counts):
+        """Drops the rows whose username is already taken, before hashing them"""
+        existing = set(User.objects.filter(username__in=[row["username"] for row in batch])
+                       .values_list("username", flat=True))
+        counts["existing"] += len(existing)
+        return [row for row in batch if row["username"] not in existing]
+
+    @staticmethod
+    def flush(batch, hashes, questions, counts, stderr):
+        """Inserts the users with their hashed passwords, then their recovery answers"""
+        users, answers = [], []
+        for row, password in zip(batch, hashes):
+            user = User(username=row["username"], password=password,
+                        **{field: row.get(field) or "" for field in USER_FIELDS})
+            users.append(user)
+            if not row.get("password"):
+                counts["no_password"] += 1
+            if row.get("question"):
+                answers.append(Answer(user=user, recovery_question=questions[row["question"]],
+                                      answer=row["answer"]))
+
+        # Users are shared in default, answers belong to the salon. The two
+        # databases cannot commit together, so answers follow committed users
+        with transaction.atomic(using="default"):
+            User.objects.bulk_create(users)
+        counts["created"] += len(users)
+        if not answers:
+            return
+        try:
+            with transaction.atomic(using=salon_db()):
+                Answer.objects.bulk_create(answers)
+        except DatabaseError as error:
+            counts["failed_answers"] += len(answers)
+            stderr.write(f"Answers of users {answers[0].user.username} to "
+                         f"{answers[-1].user.username} not saved: {error}")
+            return
+        counts["answers"] += len(answers)
+
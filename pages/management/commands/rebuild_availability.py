@@ -0,0 +1,49 @@
+"""Command for recomputing the per-day slot counters"""
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, Q
+from django.db.models.functions import TruncDate
+
+from pages.models import Appointment, DailyAvailability
+from pages.tenancy import salon_db
+
+
+def expected_counts():
+    """Returns {day: (open, booked)} computed from the Appointment table"""
+    rows = (Appointment.objects
+            .annotate(day=TruncDate("start_date"))
+            .values("day")
+            .annotate(open=Count("id", filter=Q(user_id__isnull=True)),
+                      booked=Count("id", filter=Q(user_id__isnull=False)))
+            .order_by())
+    return {row["day"]: (row["open"], row["booked"]) for row in rows}
+
+
+class Command(BaseCommand):
+    """Recomputes DailyAvailability from scratch and reports drift"""
+    help = "Rebuild the DailyAvailability table from appointments"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--check", action="store_true",
+                            help="Only report drift, do not rewrite the table")
+
+    def handle(self, *args, **options):
+        with transaction.atomic(using=salon_db()):
+            expected = expected_counts()
+            stored = {row.day: (row.open_count, row.booked_count)
+                      for row in DailyAvailability.objects.all()}
+
+            drifted = sorted(day for day in expected.keys() | stored.keys()
+                             if expected.get(day, (0, 0)) != stored.get(day, (0, 0)))
+            for day in drifted:
+                self.stdout.write(f"{day}: stored {stored.get(day, (0, 0))}, "
+                                  f"expected {expected.get(day, (0, 0))}")
+
+            if not options["check"]:
+                DailyAvailability.objects.all().delete()
+                DailyAvailability.objects.bulk_create(
+                    DailyAvailability(day=day, open_count=counts[0], booked_count=counts[1])
+                    for day, counts in expected.items())
+
+        verb = "found" if options["check"] else "fixed"
+        self.stdout.write(self.style.SUCCESS(f"{len(drifted)} drifted days {verb}"))
@@ -0,0 +1,14 @@
+"""Input files shared by the import commands"""
+import sys
+
+from django.core.management.base import CommandError
+
+
+def open_input(path):
+    """Opens the input file, or wraps stdin so it is not closed"""
+    if path == "-":
+        return open(sys.stdin.fileno(), encoding="utf-8", newline="", closefd=False)
+    try:
+        return open(path, encoding="utf-8", newline="")
+    except OSError as error:
+        raise CommandError(f"Cannot read {path}: {error}") from error
@@ -0,0 +1,176 @@
+"""Module for middleware that watches query patterns and request load"""
+import logging
+import re
+import sys
+import threading
+from collections import Counter
+from contextlib import ExitStack
+from pathlib import Path
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.http import HttpResponse
+from django.urls import Resolver404, resolve
+
+logger = logging.getLogger("pages.queries")
+load_logger = logging.getLogger("pages.load")
+
+# Same statement shape run more often than this in one request is reported
+DEFAULT_THRESHOLD = 5
+
+IN_LIST = re.compile(r"\bIN \((?:%s, )*%s\)")
+STRING = re.compile(r"'(?:[^']|'')*'")
+NUMBER = re.compile(r"\b\d+(?:\.\d+)?\b")
+
+
+def fingerprint(sql):
+    """Returns the statement with its parameters and literals replaced"""
+    sql = IN_LIST.sub("IN (...)", sql)
+    sql = STRING.sub("?", sql)
+    return NUMBER.sub("?", sql.replace("%s", "?"))
+
+
+def query_origin():
+    """Returns the template line or project source line that ran the query"""
+    project = str(settings.BASE_DIR)
+    here = str(Path(__file__).resolve())
+    frame = sys._getframe(2)  # pylint: disable=protected-access
+    source = None
+    while frame is not None:
+        node = frame.f_locals.get("self")
+        if frame.f_code.co_name == "render_annotated" and getattr(node, "origin", None):
+            # Innermost template node being rendered
+            name = node.origin.template_name or node.origin.name
+            return f"{name}:{node.token.lineno}"
+        filename = frame.f_code.co_filename
+        if (source is None and filename.startswith(project) and filename != here
+                and "site-packages" not in filename):
+            source = f"{Path(filename).relative_to(project)}:{frame.f_lineno}"
+        frame = frame.f_back
+    return source or "unknown"
+
+
+class RepeatedQueryMiddleware:
+    """Flags statement shapes repeated within one request, a sign of N+1 queries
+
+    Active only when DEBUG is on. The summary is sent in the X-Repeated-Queries
+    response header and logged to the pages.queries logger.
+    """
+
+    def __init__(self, get_response):
+        if not settings.DEBUG:
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+        self.threshold = getattr(settings, "QUERY_REPEAT_THRESHOLD", DEFAULT_THRESHOLD)
+
+    def __call__(self, request):
+        counts = Counter()
+        origins = {}
+
+        def record(execute, sql, params, many, context):
+            shape = fingerprint(sql)
+            counts[shape] += 1
+            if shape not in origins:
+                origins[shape] = query_origin()
+            return execute(sql, params, many, context)
+
+        with ExitStack() as stack:
+            for conn in connections.all():
+                stack.enter_context(conn.execute_wrapper(record))
+            response = self.get_response(request)
+
+        repeated = [(count, shape) for shape, count in counts.items() if count > self.threshold]
+        if repeated:
+            repeated.sort(reverse=True)
+            summary = "; ".join(f"{count}x at {origins[shape]}" for count, shape in repeated)
+            response["X-Repeated-Queries"] = summary
+            for count, shape in repeated:
+                logger.warning("Query ran %d times in %s %s from %s: %s", count,
+                               request.method, request.path, origins[shape], shape)
+        return response
+
+
+class Gate:
+    """Lets a limited number of requests through and a few more wait in line"""
+
+    def __init__(self, limit, queue_size, timeout):
+        self.limit = limit
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.in_flight = 0
+        self.waiting = 0
+        self.condition = threading.Condition()
+
+    def enter(self):
+        """Returns False when the line is full or the wait timed out"""
+        with self.condition:
+            if self.in_flight >= self.limit:
+                if self.waiting >= self.queue_size:
+                    return False
+                self.waiting += 1
+                try:
+                    admitted = self.condition.wait_for(
+                        lambda: self.in_flight < self.limit, self.timeout)
+                finally:
+                    self.waiting -= 1
+                if not admitted:
+                    return False
+            self.in_flight += 1
+            return True
+
+    def leave(self):
+        """Frees the slot for the next waiting request"""
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify()
+
+
+class ConcurrencyLimitMiddleware:
+    """Caps in-flight requests per URL name and sheds the excess with a 503
+
+    CONCURRENCY_LIMITS maps URL names to the number of requests let through
+    at once in this process, per salon. Up to CONCURRENCY_QUEUE_SIZE more
+    wait at most CONCURRENCY_QUEUE_TIMEOUT seconds, the rest are answered
+    right away so they don't hold a worker waiting for the write lock.
+    Views not listed are never limited.
+    """
+
+    def __init__(self, get_response):
+        self.limits = getattr(settings, "CONCURRENCY_LIMITS", {})
+        if not self.limits:
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+        self.queue_size = getattr(settings, "CONCURRENCY_QUEUE_SIZE", 4)
+        self.timeout = getattr(settings, "CONCURRENCY_QUEUE_TIMEOUT", 1.0)
+        self.retry_after = getattr(settings, "CONCURRENCY_RETRY_AFTER", 2)
+        self.gates = {}
+        self.lock = threading.Lock()
+
+    def gate(self, key, limit):
+        """Returns the gate of a salon's URL name, creating it on first use"""
+        with self.lock:
+            if key not in self.gates:
+                self.gates[key] = Gate(limit, self.queue_size, self.timeout)
+            return self.gates[key]
+
+    def __call__(self, request):
+        try:
+            name = resolve(request.path_info).url_name
+        except Resolver404:
+            name = None
+        if name not in self.limits:
+            return self.get_response(request)
+
+        gate = self.gate((getattr(request, "salon", None), name), self.limits[name])
+        if not gate.enter():
+            load_logger.warning("Shed %s %s, %d in flight", request.method,
+                                request.path, gate.in_flight)
+            response = HttpResponse("Too many requests right now, please try again shortly.",
+                                    status=503, content_type="text/plain")
+            response["Retry-After"] = str(self.retry_after)
+            return response
+        try:
+            return self.get_response(request)
+        finally:
+            gate.leave()
@@ -0,0 +1,32 @@
+# Generated by Django 5.2.18 on 2026-10-19 15:58
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pages', '0011_alter_appointment_msg_text'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='appointment',
+            name='start_date',
+            field=models.DateTimeField(db_index=True, verbose_name='date starts'),
+        ),
+        migrations.CreateModel(
+            name='ArchivedAppointment',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('start_date', models.DateTimeField(db_index=True, verbose_name='date starts')),
+                ('book_date', models.DateTimeField(verbose_name='date booked')),
+                ('msg_text', models.CharField(blank=True, max_length=200, null=True)),
+                ('archived_date', models.DateTimeField(auto_now_add=True, verbose_name='date archived')),
+                ('user_id', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-19 16:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pages', '0012_archivedappointment'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SlotEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('added', 'Slot added'), ('booked', 'Slot booked')], max_length=10)),
+                ('appointment_id', models.BigIntegerField()),
+                ('start_date', models.DateTimeField(verbose_name='date starts')),
+                ('created', models.DateTimeField(auto_now_add=True, db_index=True, verbose_name='date created')),
+            ],
+        ),
+    ]
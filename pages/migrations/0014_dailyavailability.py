@@ -0,0 +1,44 @@
+# Generated by Django 5.2.18 on 2026-10-19 16:04
+
+from django.db import migrations, models
+from django.db.models import Count, Q
+from django.db.models.functions import TruncDate
+
+
+def fill_counters(apps, schema_editor):
+    """Count the existing appointments per day"""
+    Appointment = apps.get_model('pages', 'Appointment')
+    DailyAvailability = apps.get_model('pages', 'DailyAvailability')
+    # The router follows the active salon, not the database being migrated
+    using = schema_editor.connection.alias
+    rows = (Appointment.objects.using(using)
+            .annotate(day=TruncDate('start_date'))
+            .values('day')
+            .annotate(open=Count('id', filter=Q(user_id__isnull=True)),
+                      booked=Count('id', filter=Q(user_id__isnull=False)))
+            .order_by())
+    DailyAvailability.objects.using(using).bulk_create(
+        DailyAvailability(day=row['day'], open_count=row['open'], booked_count=row['booked'])
+        for row in rows)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pages', '0013_slotevent'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyAvailability',
+            fields=[
+                ('day', models.DateField(primary_key=True, serialize=False)),
+                ('open_count', models.IntegerField(default=0)),
+                ('booked_count', models.IntegerField(default=0)),
+            ],
+            options={
+                'verbose_name_plural': 'daily availability',
+            },
+        ),
+        migrations.RunPython(fill_counters, migrations.RunPython.noop),
+    ]
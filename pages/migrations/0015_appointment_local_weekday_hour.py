@@ -0,0 +1,30 @@
+# Generated by Django 5.2.18 on 2026-10-19 16:20
+
+from zoneinfo import ZoneInfo
+
+import django.db.models.functions.datetime
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pages', '0014_dailyavailability'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='appointment',
+            name='local_weekday',
+            field=models.GeneratedField(db_persist=True, expression=django.db.models.functions.datetime.ExtractIsoWeekDay('start_date', tzinfo=ZoneInfo('Europe/Helsinki')), output_field=models.PositiveSmallIntegerField()),
+        ),
+        migrations.AddField(
+            model_name='appointment',
+            name='local_hour',
+            field=models.GeneratedField(db_persist=True, expression=django.db.models.functions.datetime.ExtractHour('start_date', tzinfo=ZoneInfo('Europe/Helsinki')), output_field=models.PositiveSmallIntegerField()),
+        ),
+        migrations.AddIndex(
+            model_name='appointment',
+            index=models.Index(fields=['local_weekday', 'local_hour', 'start_date'], name='appointment_weekday_hour_idx'),
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 5.2.18 on 2026-10-19 16:08
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pages', '0015_appointment_local_weekday_hour'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Resource',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True)),
+                ('kind', models.CharField(choices=[('stylist', 'Stylist'), ('chair', 'Chair')], default='stylist', max_length=10)),
+                ('active', models.BooleanField(default=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='appointment',
+            name='resource',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, to='pages.resource'),
+        ),
+        migrations.AddField(
+            model_name='archivedappointment',
+            name='resource',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='pages.resource'),
+        ),
+        migrations.AddIndex(
+            model_name='appointment',
+            index=models.Index(condition=models.Q(('user_id__isnull', True)), fields=['start_date', 'resource'], name='appointment_open_start_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='appointment',
+            constraint=models.UniqueConstraint(fields=('resource', 'start_date'), name='appointment_unique_resource_start'),
+        ),
+    ]
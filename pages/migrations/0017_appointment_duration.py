@@ -0,0 +1,53 @@
+# Generated by Django 5.2.18 on 2026-10-19 16:09
+
+import datetime
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import ExpressionWrapper, F
+
+
+def fill_end_dates(apps, schema_editor):
+    """Existing appointments keep the default length"""
+    Appointment = apps.get_model('pages', 'Appointment')
+    Appointment.objects.using(schema_editor.connection.alias).update(end_date=ExpressionWrapper(
+        F('start_date') + F('duration'), output_field=models.DateTimeField()))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pages', '0016_resource'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='appointment',
+            name='duration',
+            field=models.DurationField(default=datetime.timedelta(seconds=1800)),
+        ),
+        migrations.AddField(
+            model_name='appointment',
+            name='end_date',
+            field=models.DateTimeField(editable=False, null=True, verbose_name='date ends'),
+        ),
+        migrations.RunPython(fill_end_dates, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='appointment',
+            name='end_date',
+            field=models.DateTimeField(editable=False, verbose_name='date ends'),
+        ),
+        migrations.AddField(
+            model_name='archivedappointment',
+            name='end_date',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='date ends'),
+        ),
+        migrations.AddIndex(
+            model_name='appointment',
+            index=models.Index(condition=models.Q(('user_id__isnull', False)), fields=['resource', 'start_date', 'end_date'], name='appointment_booked_span_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='appointment',
+            constraint=models.CheckConstraint(condition=models.Q(('duration__gt', datetime.timedelta(0)), ('duration__lte', datetime.timedelta(seconds=28800))), name='appointment_duration_range'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.2.18 on 2026-10-19 16:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pages', '0017_appointment_duration'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IdempotencyKey',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('scope', models.CharField(max_length=50)),
+                ('owner', models.CharField(blank=True, max_length=50)),
+                ('key', models.CharField(max_length=100)),
+                ('status_code', models.PositiveSmallIntegerField(blank=True, null=True)),
+                ('location', models.CharField(blank=True, max_length=200)),
+                ('content_type', models.CharField(blank=True, max_length=100)),
+                ('body', models.BinaryField(blank=True)),
+                ('stored_messages', models.JSONField(blank=True, default=list)),
+                ('created', models.DateTimeField(auto_now_add=True, db_index=True, verbose_name='date created')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('scope', 'key'), name='idempotency_unique_key')],
+            },
+        ),
+    ]
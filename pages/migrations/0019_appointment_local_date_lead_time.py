@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-19 16:40
+
+from zoneinfo import ZoneInfo
+
+import django.db.models.expressions
+import django.db.models.functions.datetime
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pages', '0018_idempotencykey'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='appointment',
+            name='local_date',
+            field=models.GeneratedField(db_persist=True, expression=django.db.models.functions.datetime.TruncDate('start_date', tzinfo=ZoneInfo('Europe/Helsinki')), output_field=models.DateField()),
+        ),
+        migrations.AddField(
+            model_name='appointment',
+            name='lead_time',
+            field=models.GeneratedField(db_persist=True, expression=django.db.models.expressions.CombinedExpression(models.F('start_date'), '-', models.F('book_date')), output_field=models.DurationField()),
+        ),
+    ]
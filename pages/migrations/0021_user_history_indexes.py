@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-19 16:31
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pages', '0020_user_fk_without_db_constraint'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='appointment',
+            index=models.Index(fields=['user_id', 'start_date', 'id'], name='appointment_user_start_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='archivedappointment',
+            index=models.Index(fields=['user_id', 'start_date', 'id'], name='archived_user_start_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-19 17:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pages', '0021_user_history_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='slotevent',
+            name='resource_id',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+    ]
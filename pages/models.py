@@ -1,16 +1,185 @@
 """Module for managing models, users and time"""
+from datetime import timedelta
+from zoneinfo import ZoneInfo
 from django.utils import timezone
 from django.contrib.auth import get_user_model
-from django.db import models
+from django.db import IntegrityError, models, router, transaction
+from django.db.models import Count, F, Q
+from django.db.models.functions import ExtractHour, ExtractIsoWeekDay, TruncDate
 
 User = get_user_model()
 
+# Weekday and hour searches are in the salon's local time
+SALON_TIMEZONE = ZoneInfo("Europe/Helsinki")
+
+# Appointment length unless set otherwise
+DEFAULT_DURATION = timedelta(minutes=30)
+# Upper bound of appointment length, keeps the overlap query an index range scan
+MAX_DURATION = timedelta(hours=8)
+
+class Resource(models.Model):
+    """Stylist or chair that appointments are booked with"""
+    STYLIST = "stylist"
+    CHAIR = "chair"
+    KINDS = [
+        (STYLIST, "Stylist"),
+        (CHAIR, "Chair"),
+    ]
+
+    name = models.CharField(max_length=100, unique=True)
+    kind = models.CharField(max_length=10, choices=KINDS, default=STYLIST)
+    active = models.BooleanField(default=True)
+
+    def __str__(self):
+        return self.name
+
+class AppointmentQuerySet(models.QuerySet):
+    """Queries shared by the booking views"""
+
+    def free(self, resources=None, limit=None):
+        """Open future slots, optionally of the given resource ids and at most limit of them
+
+        Slots of deactivated resources are left out, slots without a resource are kept.
+        """
+        slots = self.filter(Q(resource__isnull=True) | Q(resource__active=True),
+                            user_id__isnull=True, start_date__gte=timezone.now())
+        if resources:
+            slots = slots.filter(resource_id__in=resources)
+        slots = slots.select_related("resource").order_by("start_date", "resource_id")
+        return slots if limit is None else slots[:limit]
+
+    def delete_counted(self):
+        """Deletes the appointments with one DELETE and subtracts them per day
+
+        No signals are sent, so DailyAvailability is adjusted once per day
+        from an aggregate instead of once per row. Nothing refers to
+        appointments, so there is nothing to cascade.
+        """
+        using = self._db or router.db_for_write(self.model)
+        with transaction.atomic(using=using):
+            per_day = list(self.annotate(day=TruncDate("start_date"))
+                           .values("day")
+                           .annotate(open=Count("id", filter=Q(user_id__isnull=True)),
+                                     booked=Count("id", filter=Q(user_id__isnull=False)))
+                           .order_by())
+            count = self._raw_delete(using)  # pylint: disable=protected-access
+            for row in per_day:
+                DailyAvailability.adjust(row["day"], open_delta=-row["open"],
+                                         booked_delta=-row["booked"], using=using)
+        return count
+
+    def overlapping(self, resource_id, start_date, end_date):
+        """Booked appointments of the resource overlapping [start_date, end_date)"""
+        # No appointment is longer than MAX_DURATION, so only starts after
+        # start_date - MAX_DURATION can overlap and the scan stays bounded
+        return self.filter(resource_id=resource_id,
+                           user_id__isnull=False,
+                           start_date__gt=start_date - MAX_DURATION,
+                           start_date__lt=end_date,
+                           end_date__gt=start_date)
+
 class Appointment(models.Model):
     """Class for appointment"""
-    start_date = models.DateTimeField("date starts")
+    start_date = models.DateTimeField("date starts", db_index=True)
     book_date = models.DateTimeField("date booked", auto_now=True)
     msg_text = models.CharField(max_length=200, null=True, blank=True)
-    user_id = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True)
+    # Users are shared in the default database, salon data may live elsewhere
+    user_id = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True,
+                                db_constraint=False)
+    resource = models.ForeignKey(Resource, on_delete=models.PROTECT, null=True, blank=True)
+    duration = models.DurationField(default=DEFAULT_DURATION)
+    end_date = models.DateTimeField("date ends", editable=False)
+    # Monday is 1 and Sunday is 7
+    local_weekday = models.GeneratedField(
+        expression=ExtractIsoWeekDay("start_date", tzinfo=SALON_TIMEZONE),
+        output_field=models.PositiveSmallIntegerField(), db_persist=True)
+    local_hour = models.GeneratedField(
+        expression=ExtractHour("start_date", tzinfo=SALON_TIMEZONE),
+        output_field=models.PositiveSmallIntegerField(), db_persist=True)
+    # Stored so reports group on plain columns instead of per-row date functions
+    local_date = models.GeneratedField(
+        expression=TruncDate("start_date", tzinfo=SALON_TIMEZONE),
+        output_field=models.DateField(), db_persist=True)
+    lead_time = models.GeneratedField(
+        expression=F("start_date") - F("book_date"),
+        output_field=models.DurationField(), db_persist=True)
+
+    objects = AppointmentQuerySet.as_manager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["resource", "start_date"],
+                                    name="appointment_unique_resource_start"),
+            models.CheckConstraint(condition=models.Q(duration__gt=timedelta(0),
+                                                      duration__lte=MAX_DURATION),
+                                   name="appointment_duration_range"),
+        ]
+        indexes = [
+            models.Index(fields=["local_weekday", "local_hour", "start_date"],
+                         name="appointment_weekday_hour_idx"),
+            # Only open slots, so finding the first free ones skips booked history
+            models.Index(fields=["start_date", "resource"],
+                         condition=models.Q(user_id__isnull=True),
+                         name="appointment_open_start_idx"),
+            # Booked intervals per resource for the overlap check
+            models.Index(fields=["resource", "start_date", "end_date"],
+                         condition=models.Q(user_id__isnull=False),
+                         name="appointment_booked_span_idx"),
+            # Keyset pages of a user's bookings
+            models.Index(fields=["user_id", "start_date", "id"],
+                         name="appointment_user_start_idx"),
+        ]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance.remember_state()
+        return instance
+
+    def remember_state(self):
+        """Stores the counted state so a later save can move the counters"""
+        self._counted_state = self.counter_state()
+
+    def counter_state(self, stored=None):
+        """Returns the (day, booked) bucket of DailyAvailability, None if unknown
+
+        Fields deferred by only() are not saved, so their part of the bucket
+        is taken from the stored bucket when one is given.
+        """
+        start_date = self.__dict__.get("start_date")
+        day = timezone.localdate(start_date) if start_date else stored and stored[0]
+        if "user_id_id" in self.__dict__:
+            booked = self.user_id_id is not None
+        else:
+            booked = stored[1] if stored else None
+        if day is None or booked is None:
+            return None
+        return day, booked
+
+    def load_stored_state(self, using):
+        """Reads the counted bucket from the database when it is not known"""
+        if self._state.adding or getattr(self, "_counted_state", None) is not None:
+            return
+        row = (Appointment.objects.using(using).filter(pk=self.pk)
+               .values_list("start_date", "user_id").first())
+        if row is not None:
+            self._counted_state = timezone.localdate(row[0]), row[1] is not None
+
+    def save(self, *args, **kwargs):
+        self.end_date = self.start_date + self.duration
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None and {"start_date", "duration"} & set(update_fields):
+            kwargs["update_fields"] = {*update_fields, "end_date"}
+        super().save(*args, **kwargs)
+
+    def overlaps_booking(self) -> bool:
+        """Returns true if another booking of the same resource overlaps this one"""
+        if self.resource_id is None:
+            return False
+        return (Appointment.objects.db_manager(self._state.db)
+                .overlapping(self.resource_id, self.start_date, self.end_date)
+                .exclude(id=self.id)
+                .exists())
 
     def is_open_for_booking(self) -> bool:
         """Returns true if appointment is available for booking"""
@@ -25,7 +194,123 @@ class Appointment(models.Model):
     def __str__(self):
         # pylint: disable=no-member
         booked = f"booked for {self.user_id.username})" if self.user_id else "not booked yet"
-        return f"ID {self.id} : {self.start_date} ({booked})"
+        with_resource = f" with {self.resource}" if self.resource_id else ""
+        return f"ID {self.id} : {self.start_date}{with_resource} ({booked})"
+
+class ArchivedAppointment(models.Model):
+    """Class for past appointments moved out of the Appointment table"""
+    start_date = models.DateTimeField("date starts", db_index=True)
+    book_date = models.DateTimeField("date booked")
+    msg_text = models.CharField(max_length=200, null=True, blank=True)
+    user_id = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True,
+                                db_constraint=False)
+    resource = models.ForeignKey(Resource, on_delete=models.SET_NULL, null=True, blank=True)
+    end_date = models.DateTimeField("date ends", null=True, blank=True)
+    archived_date = models.DateTimeField("date archived", auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            # Keyset pages of a user's bookings
+            models.Index(fields=["user_id", "start_date", "id"],
+                         name="archived_user_start_idx"),
+        ]
+
+    @classmethod
+    def from_appointment(cls, appointment):
+        """Returns an unsaved archive row keeping the original id"""
+        return cls(id=appointment.id,
+                   start_date=appointment.start_date,
+                   book_date=appointment.book_date,
+                   msg_text=appointment.msg_text,
+                   user_id_id=appointment.user_id_id,
+                   resource_id=appointment.resource_id,
+                   end_date=appointment.end_date)
+
+    def __str__(self):
+        return f"ID {self.id} : {self.start_date} (archived)"
+
+class DailyAvailability(models.Model):
+    """Number of open and booked appointments per local day, kept up to date on write"""
+    day = models.DateField(primary_key=True)
+    open_count = models.IntegerField(default=0)
+    booked_count = models.IntegerField(default=0)
+
+    class Meta:
+        verbose_name_plural = "daily availability"
+
+    @classmethod
+    def adjust(cls, day, open_delta=0, booked_delta=0, using=None):
+        """Adds the deltas to the day's counters with an atomic UPDATE"""
+        if not open_delta and not booked_delta:
+            return
+        counters = cls.objects.db_manager(using)
+        changes = {"open_count": F("open_count") + open_delta,
+                   "booked_count": F("booked_count") + booked_delta}
+        if counters.filter(day=day).update(**changes):
+            return
+        try:
+            with transaction.atomic(using=counters.db):
+                counters.create(day=day, open_count=open_delta, booked_count=booked_delta)
+        except IntegrityError:
+            # Another writer created the row first
+            counters.filter(day=day).update(**changes)
+
+    @classmethod
+    def move(cls, old_state, new_state, using=None):
+        """Moves one appointment between (day, booked) buckets"""
+        if old_state == new_state:
+            return
+        if old_state is not None:
+            day, booked = old_state
+            cls.adjust(day, open_delta=0 if booked else -1, booked_delta=-1 if booked else 0,
+                       using=using)
+        if new_state is not None:
+            day, booked = new_state
+            cls.adjust(day, open_delta=0 if booked else 1, booked_delta=1 if booked else 0,
+                       using=using)
+
+    def __str__(self):
+        return f"{self.day} : {self.open_count} open, {self.booked_count} booked"
+
+class IdempotencyKey(models.Model):
+    """Stored response of a POST, replayed when the client retries with the same key"""
+    scope = models.CharField(max_length=50)
+    owner = models.CharField(max_length=50, blank=True)
+    key = models.CharField(max_length=100)
+    status_code = models.PositiveSmallIntegerField(null=True, blank=True)
+    location = models.CharField(max_length=200, blank=True)
+    content_type = models.CharField(max_length=100, blank=True)
+    body = models.BinaryField(blank=True)
+    stored_messages = models.JSONField(default=list, blank=True)
+    created = models.DateTimeField("date created", auto_now_add=True, db_index=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["scope", "key"],
+                                    name="idempotency_unique_key"),
+        ]
+
+    def __str__(self):
+        return f"{self.scope} {self.key} : {self.status_code or 'in progress'}"
+
+class SlotEvent(models.Model):
+    """Change log of slot availability, read by the event stream of every worker"""
+    ADDED = "added"
+    BOOKED = "booked"
+    KINDS = [
+        (ADDED, "Slot added"),
+        (BOOKED, "Slot booked"),
+    ]
+
+    kind = models.CharField(max_length=10, choices=KINDS)
+    appointment_id = models.BigIntegerField()
+    start_date = models.DateTimeField("date starts")
+    # Lets pages filtered by resource skip other resources' slots
+    resource_id = models.BigIntegerField(null=True, blank=True)
+    created = models.DateTimeField("date created", auto_now_add=True, db_index=True)
+
+    def __str__(self):
+        return f"{self.kind} {self.appointment_id} : {self.start_date}"
 
 # SECURITY FLAW 5: Security Misconfiguration:
 # Fix by disabling Question class
@@ -48,7 +333,7 @@ class Question(models.Model):
 # Fix by disabling Answer class
 class Answer(models.Model):
     """User answers for recovery questions"""
-    user = models.OneToOneField(User, on_delete=models.CASCADE)
+    user = models.OneToOneField(User, on_delete=models.CASCADE, db_constraint=False)
     recovery_question = models.ForeignKey(Question, on_delete=models.CASCADE, null=True, blank=True)
     answer = models.CharField(max_length=200, null=True, blank=True)
     saved_date = models.DateTimeField("date saved", auto_now=True)
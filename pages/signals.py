@@ -1,11 +1,78 @@
-"""Module for presetting questions on db"""
-from django.db.models.signals import post_migrate
+"""Module for presetting questions on db and tracking slot changes"""
+from django.db import DEFAULT_DB_ALIAS, router
+from django.db.models.signals import (post_delete, post_migrate, post_save, pre_delete,
+                                      pre_save)
 from django.dispatch import receiver
-from .models import Question
+from django.utils import timezone
+from django.contrib.auth import get_user_model
+from . import dashboard
+from .events import announce
+from .models import Answer, Appointment, ArchivedAppointment, DailyAvailability, Question, SlotEvent
+from .tenancy import salon_of, salons
 
 @receiver(post_migrate)
 def create_default_questions(sender, **kwargs):
     """Preset recovery questions to the database on start"""
-    if sender.name == "pages":  # only run for your app
+    using = kwargs.get("using", DEFAULT_DB_ALIAS)
+    if sender.name == "pages" and router.allow_migrate_model(using, Question):
         for key, _ in Question.PASSWORD_QUESTIONS:
-            Question.objects.get_or_create(text=key)
+            Question.objects.using(using).get_or_create(text=key)
+
+@receiver(post_save, sender=Appointment)
+def log_slot_event(sender, instance, created, using, **kwargs):
+    # pylint: disable=unused-argument
+    """Record future slot changes in the change log read by the event stream"""
+    if instance.start_date < timezone.now():
+        return
+    kind = SlotEvent.BOOKED if instance.user_id_id else SlotEvent.ADDED
+    announce(kind, [instance], using)
+
+@receiver(pre_save, sender=Appointment)
+def load_counted_slot(sender, instance, raw, using, **kwargs):
+    # pylint: disable=unused-argument
+    """Read the stored bucket of an instance loaded with its fields deferred"""
+    if not raw:
+        instance.load_stored_state(using)
+
+@receiver(post_save, sender=Appointment)
+@receiver(post_delete, sender=Appointment)
+def refresh_dashboard_history(sender, instance, using, **kwargs):
+    # pylint: disable=unused-argument
+    """Drop the cached dashboard history when a slot before today changes
+
+    Connected before the counters, which replace the remembered old bucket.
+    """
+    days = [state[0] for state in [getattr(instance, "_counted_state", None)] if state]
+    if "start_date" in instance.__dict__:
+        days.append(timezone.localdate(instance.start_date))
+    if any(day < timezone.localdate() for day in days):
+        dashboard.clear(salon_of(using))
+
+@receiver(post_save, sender=Appointment)
+def count_saved_slot(sender, instance, created, using, **kwargs):
+    # pylint: disable=unused-argument, protected-access
+    """Keep DailyAvailability in step with a created or changed appointment"""
+    old_state = None if created else getattr(instance, "_counted_state", None)
+    new_state = instance.counter_state(old_state)
+    if (old_state is None and not created) or new_state is None:
+        # Unknown bucket, moving one side only would drift,
+        # rebuild_availability corrects what is missed
+        return
+    DailyAvailability.move(old_state, new_state, using=using)
+    instance.remember_state()
+
+@receiver(post_delete, sender=Appointment)
+def count_deleted_slot(sender, instance, using, **kwargs):
+    # pylint: disable=unused-argument
+    """Remove a deleted appointment from DailyAvailability"""
+    old_state = getattr(instance, "_counted_state", None) or instance.counter_state()
+    DailyAvailability.move(old_state, None, using=using)
+
+@receiver(pre_delete, sender=get_user_model())
+def delete_salon_data(sender, instance, using, **kwargs):
+    # pylint: disable=unused-argument
+    """Cascade a user deletion into the other salon databases"""
+    for alias in set(salons().values()) - {using}:
+        Appointment.objects.using(alias).filter(user_id=instance.pk).delete()
+        ArchivedAppointment.objects.using(alias).filter(user_id=instance.pk).delete()
+        Answer.objects.using(alias).filter(user=instance.pk).delete()
@@ -0,0 +1,15 @@
+"""Template tag for idempotency keys in forms"""
+import uuid
+
+from django import template
+from django.utils.html import format_html
+
+from pages.idempotency import FORM_FIELD
+
+register = template.Library()
+
+
+@register.simple_tag
+def idempotency_key():
+    """Hidden input with a new key, so a resent form is recognised as a retry"""
+    return format_html('<input type="hidden" name="{}" value="{}">', FORM_FIELD, uuid.uuid4())
@@ -0,0 +1,117 @@
+"""Module for salon tenancy: each salon's booking data lives in its own database"""
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+
+from django.conf import settings
+from django.db import transaction
+from django.urls import get_script_prefix, set_script_prefix
+
+# Apps whose tables live in every salon database, everything else is shared
+TENANT_APPS = {"pages"}
+
+_current_salon = ContextVar("salon", default=None)
+
+
+def salons():
+    """Returns {salon slug: database alias}"""
+    return settings.SALONS
+
+
+def default_salon():
+    """The salon used when the request or command names none"""
+    return next(iter(salons()))
+
+
+def current_salon():
+    """Returns the slug of the active salon"""
+    return _current_salon.get() or default_salon()
+
+
+def salon_db(salon=None):
+    """Returns the database alias of the given or active salon"""
+    return salons()[salon or current_salon()]
+
+
+def salon_of(alias):
+    """Returns the salon whose data lives in the database alias, None if none"""
+    return next((salon for salon, db in salons().items() if db == alias), None)
+
+
+@contextmanager
+def use_salon(salon):
+    """Routes salon data to the given salon inside the block"""
+    if salon not in salons():
+        raise KeyError(f"Unknown salon {salon}")
+    token = _current_salon.set(salon)
+    try:
+        yield
+    finally:
+        _current_salon.reset(token)
+
+
+def salon_atomic(func):
+    """transaction.atomic on the active salon's database"""
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with transaction.atomic(using=salon_db()):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+class SalonRouter:
+    """Sends salon data to the active salon's database and the rest to default"""
+
+    def db_for_read(self, model, **hints):
+        # pylint: disable=unused-argument
+        """Salon database for salon apps, default for shared apps"""
+        if model._meta.app_label in TENANT_APPS:
+            return salon_db()
+        return "default"
+
+    db_for_write = db_for_read
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # pylint: disable=unused-argument
+        """Salon data refers to shared users across databases"""
+        return True
+
+    def allow_migrate(self, db, app_label, **hints):
+        # pylint: disable=unused-argument
+        """Salon apps are migrated in every salon database, shared apps in default"""
+        if app_label in TENANT_APPS:
+            return db in salons().values()
+        return db == "default"
+
+
+def salon_from_request(request):
+    """Returns (salon, URL prefix) chosen by subdomain or first path segment"""
+    subdomain = request.get_host().split(":")[0].split(".")[0]
+    if subdomain in salons():
+        return subdomain, ""
+    first = request.path_info.lstrip("/").split("/", 1)[0]
+    if first in salons():
+        return first, f"/{first}"
+    return default_salon(), ""
+
+
+class SalonMiddleware:
+    """Activates the salon of the request and strips its URL prefix"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        salon, prefix = salon_from_request(request)
+        request.salon = salon
+        old_prefix = get_script_prefix()
+        if prefix:
+            # Resolve the rest of the path, and reverse() URLs back under the prefix
+            request.path_info = request.path_info[len(prefix):] or "/"
+            request.META["SCRIPT_NAME"] = request.META.get("SCRIPT_NAME", "") + prefix
+            set_script_prefix(request.META["SCRIPT_NAME"] + "/")
+        try:
+            with use_salon(salon):
+                return self.get_response(request)
+        finally:
+            set_script_prefix(old_prefix)
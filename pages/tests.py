@@ -1,19 +1,57 @@
 """Test module"""
-from datetime import timedelta
+import asyncio
+import gzip
+import json
+import logging
+import logging.config
+import os
+import sqlite3
+import tempfile
+import threading
+import unittest
+from datetime import datetime, timedelta
+from io import StringIO
+from unittest import mock
 from django.utils import timezone
 
-from django.test import TestCase
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.core.management import CommandError, call_command
+from django.db import DatabaseError, IntegrityError, connection, connections
+from django.shortcuts import render
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Permission
+from django.contrib.messages import get_messages
 from django.urls import reverse, resolve
 
-from pages import views
+from pages import dashboard, views
+from pages.idempotency import IDEMPOTENCY_TTL, IN_PROGRESS_LEASE
+from pages.hashers import MIN_ITERATIONS, CalibratedPBKDF2PasswordHasher
+from pages.management.commands.backup_db import check_integrity
+from pages.management.commands.import_slots import Command as ImportSlotsCommand
+from pages.audit import JsonFormatter, QueuedRotatingFileHandler
+from pages.middleware import (ConcurrencyLimitMiddleware, Gate, RepeatedQueryMiddleware,
+                              fingerprint)
+from pages.events import SlotEventHub, event_payload
+from pages.feeds import calendar_token
 from pages.signals import create_default_questions
+from pages.tenancy import SalonRouter, salon_atomic, salon_from_request, use_salon
 
-from .models import Appointment, Question, Answer
+from .models import (Appointment, ArchivedAppointment, DailyAvailability, IdempotencyKey,
+                     Question, Answer, Resource, SlotEvent, SALON_TIMEZONE)
 
 User = get_user_model()
 
 
+def setUpModule():
+    """Keeps audit records of the test run out of logs/audit.log"""
+    audit_logger = logging.getLogger("pages.audit")
+    unittest.addModuleCleanup(setattr, audit_logger, "handlers", audit_logger.handlers)
+    audit_logger.handlers = [logging.NullHandler()]
+
+
 # Models
 class AppointmentModelTests(TestCase):
     """Tests for the Appointment model"""
@@ -155,6 +193,26 @@ class UrlTests(TestCase):
         url = reverse("changepswd")
         self.assertEqual(resolve(url).func, views.changepswd)
 
+    def test_slot_events_url_resolves(self):
+        """Check that url works"""
+        url = reverse("slot_events")
+        self.assertEqual(resolve(url).func, views.slot_events)
+
+    def test_slot_search_url_resolves(self):
+        """Check that url works"""
+        url = reverse("slot_search")
+        self.assertEqual(resolve(url).func, views.slot_search)
+
+    def test_dashboard_url_resolves(self):
+        """Check that url works"""
+        url = reverse("dashboard")
+        self.assertEqual(resolve(url).func, views.dashboard)
+
+    def test_calendar_feed_url_resolves(self):
+        """Check that url works"""
+        url = reverse("calendar_feed", args=["1:token"])
+        self.assertEqual(resolve(url).func, views.calendar_feed)
+
 # Views
 
 class ViewsTestCase(TestCase):
@@ -273,3 +331,1240 @@ class ViewsTestCase(TestCase):
         })
         self.assertEqual(response.status_code, 200)
         self.assertTemplateUsed(response, "pages/changepswd.html")
+
+# Management commands
+
+class ArchiveAppointmentsCommandTests(TestCase):
+    """Tests for the archive_appointments command"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username="tester", password="secret123")
+
+    def test_old_appointments_are_moved_in_batches(self):
+        """Appointments older than the cutoff move to the archive table"""
+        old = [Appointment.objects.create(start_date=timezone.now() - timedelta(days=60 + i),
+                                          user_id=self.user, msg_text=f"old {i}")
+               for i in range(5)]
+        recent = Appointment.objects.create(start_date=timezone.now() - timedelta(days=1))
+
+        call_command("archive_appointments", "--days=30", "--batch-size=2",
+                     "--sleep=0", stdout=StringIO())
+
+        self.assertEqual(list(Appointment.objects.all()), [recent])
+        archived = ArchivedAppointment.objects.get(id=old[0].id)
+        self.assertEqual(archived.user_id, self.user)
+        self.assertEqual(archived.msg_text, "old 0")
+        self.assertEqual(ArchivedAppointment.objects.count(), 5)
+
+    def test_index_does_not_read_archive(self):
+        """Archived appointments are left to the history page"""
+        self.client.login(username="tester", password="secret123")
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse("index"))
+        self.assertFalse([q for q in queries if "pages_archivedappointment" in q["sql"]])
+        self.assertContains(response, reverse("history"))
+
+# Admin
+
+class AppointmentAdminTests(TestCase):
+    """Tests for the tuned Appointment admin"""
+
+    def setUp(self):
+        self.admin = User.objects.create_superuser(username="admin", password="secret123")
+        self.client.login(username="admin", password="secret123")
+        self.url = reverse("admin:pages_appointment_changelist")
+
+    def create_booked(self, count, days=1):
+        """Create booked appointments each with its own user"""
+        return [Appointment.objects.create(
+            start_date=timezone.now() + timedelta(days=days, hours=i),
+            user_id=User.objects.create_user(username=f"user{days}_{i}"))
+            for i in range(count)]
+
+    def test_changelist_query_count_does_not_grow_with_rows(self):
+        """Users are joined instead of fetched row by row"""
+        self.create_booked(3)
+        with CaptureQueriesContext(connection) as small:
+            self.client.get(self.url)
+        self.create_booked(10, days=2)
+        with CaptureQueriesContext(connection) as large:
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(small), len(large))
+
+    def test_release_slots_action(self):
+        """Selected slots are released with one UPDATE"""
+        booked = self.create_booked(3)
+        with CaptureQueriesContext(connection) as queries:
+            self.client.post(self.url, {
+                "action": "release_slots",
+                "_selected_action": [a.id for a in booked],
+            })
+        updates = [q for q in queries
+                   if q["sql"].startswith('UPDATE "pages_appointment"')]
+        self.assertEqual(len(updates), 1)
+        self.assertFalse(Appointment.objects.filter(user_id__isnull=False).exists())
+
+    def test_delete_past_slots_action(self):
+        """Only the past slots of the selection are deleted"""
+        past = Appointment.objects.create(start_date=timezone.now() - timedelta(days=1))
+        future = Appointment.objects.create(start_date=timezone.now() + timedelta(days=1))
+        response = self.client.post(self.url, {
+            "action": "delete_past_slots",
+            "_selected_action": [past.id, future.id],
+        })
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(list(Appointment.objects.all()), [future])
+
+    def test_view_only_staff_cannot_run_actions(self):
+        """Releasing needs the change and deleting the delete permission"""
+        viewer = User.objects.create_user(username="viewer", password="secret123",
+                                          is_staff=True)
+        viewer.user_permissions.add(Permission.objects.get(codename="view_appointment"))
+        self.client.login(username="viewer", password="secret123")
+        past = Appointment.objects.create(start_date=timezone.now() - timedelta(days=1),
+                                          user_id=viewer)
+        for action in ("release_slots", "delete_past_slots"):
+            self.client.post(self.url, {"action": action, "_selected_action": [past.id]})
+        past.refresh_from_db()
+        self.assertEqual(past.user_id, viewer)
+
+
+class BackupCommandTests(TransactionTestCase):
+    """Tests for the backup_db command, outside a transaction so the copy can read"""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        for hour in range(50):
+            Appointment.objects.create(start_date=timezone.now() + timedelta(hours=hour))
+
+    def appointment_count(self, path):
+        """Counts appointments in a backup file"""
+        copy = sqlite3.connect(path)
+        try:
+            return copy.execute("SELECT COUNT(*) FROM pages_appointment").fetchone()[0]
+        finally:
+            copy.close()
+
+    def test_backup_in_small_steps(self):
+        """Copy made a page at a time holds all rows and passes the check"""
+        path = os.path.join(self.directory, "copy.sqlite3")
+        out = StringIO()
+        call_command("backup_db", path, "--pages", "1", "--sleep", "0", "--verify", stdout=out)
+        self.assertEqual(self.appointment_count(path), 50)
+        self.assertIn("0 restarts", out.getvalue())
+        self.assertEqual(os.listdir(self.directory), ["copy.sqlite3"])
+
+    def test_compressed_backup_in_directory(self):
+        """Directory output gets a timestamped gzip file"""
+        call_command("backup_db", self.directory, "--compress", "--verify", stdout=StringIO())
+        [name] = os.listdir(self.directory)
+        self.assertTrue(name.startswith("default-") and name.endswith(".sqlite3.gz"))
+        path = os.path.join(self.directory, "restored.sqlite3")
+        with gzip.open(os.path.join(self.directory, name)) as packed, open(path, "wb") as plain:
+            plain.write(packed.read())
+        self.assertEqual(self.appointment_count(path), 50)
+
+    def test_failed_integrity_check(self):
+        """A damaged file is reported"""
+        path = os.path.join(self.directory, "broken.sqlite3")
+        with open(path, "wb") as broken:
+            broken.write(b"SQLite format 3\x00" + b"\xff" * 4096)
+        with self.assertRaises(CommandError):
+            check_integrity(path)
+
+
+class PasswordHasherTests(TestCase):
+    """Tests for the calibrated password hasher"""
+
+    def test_iterations_follow_setting_above_floor(self):
+        """Configured count is used, but never below the floor"""
+        hasher = CalibratedPBKDF2PasswordHasher()
+        with self.settings(PASSWORD_ITERATIONS=None):
+            self.assertEqual(hasher.iterations, 1_000_000)
+        with self.settings(PASSWORD_ITERATIONS=700_000):
+            self.assertEqual(hasher.iterations, 700_000)
+        with self.settings(PASSWORD_ITERATIONS=1000):
+            self.assertEqual(hasher.iterations, MIN_ITERATIONS)
+
+    def test_login_rehashes_with_new_count(self):
+        """Existing hash is upgraded on the next login"""
+        with self.settings(PASSWORD_ITERATIONS=None):
+            user = User.objects.create_user(username="olduser", password="secret123")
+        self.assertIn("$1000000$", user.password)
+        with self.settings(PASSWORD_ITERATIONS=700_000):
+            self.assertTrue(self.client.login(username="olduser", password="secret123"))
+        user.refresh_from_db()
+        self.assertTrue(user.password.startswith("pbkdf2_sha256$700000$"))
+
+    def test_calibration_respects_floor(self):
+        """Budget too small for the floor recommends the floor with a warning"""
+        out = StringIO()
+        with self.settings(PASSWORD_HASHERS=["pages.hashers.CalibratedPBKDF2PasswordHasher"]):
+            call_command("calibrate_hasher", "--target-ms", "0.001", "--samples", "1",
+                         stdout=out)
+        self.assertIn(f"below the floor of {MIN_ITERATIONS}", out.getvalue())
+        self.assertIn(f"Set PASSWORD_ITERATIONS={MIN_ITERATIONS}", out.getvalue())
+
+    def test_floor_below_hasher_minimum_is_rejected(self):
+        """A floor the hasher would clamp away is an error"""
+        with self.assertRaises(CommandError):
+            call_command("calibrate_hasher", "--min-iterations", "2000", stdout=StringIO())
+
+
+@override_settings(PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"])
+class ImportUsersCommandTests(TestCase):
+    """Tests for the import_users command, with a fast hasher"""
+
+    def write_file(self, suffix, text):
+        """Write a temporary input file"""
+        handle = tempfile.NamedTemporaryFile("w", suffix=suffix, delete=False,
+                                             encoding="utf-8")
+        with handle:
+            handle.write(text)
+        self.addCleanup(os.remove, handle.name)
+        return handle.name
+
+    def test_csv_import_with_recovery_answers(self):
+        """Users and answers are created, bad and repeated rows are skipped"""
+        User.objects.create_user(username="taken", password="secret123")
+        path = self.write_file(".csv", "username,password,email,question,answer\n"
+                                       "anna,annapass1,anna@example.com,first_pet,Rex\n"
+                                       "ben,benpass12,,,\n"
+                                       "ben,again1234,,,\n"
+                                       "taken,secret123,,,\n"
+                                       "cara,,,nope,x\n")
+        out, err = StringIO(), StringIO()
+        call_command("import_users", path, "--workers", "2", "--batch-size", "1",
+                     stdout=out, stderr=err)
+        self.assertIn("Imported 2 users and 1 recovery answers, 1 existing, 2 invalid",
+                      out.getvalue())
+        self.assertIn("rows/s", out.getvalue())
+        self.assertIn("Line 4: duplicate username", err.getvalue())
+        self.assertTrue(User.objects.get(username="anna").check_password("annapass1"))
+        self.assertEqual(Answer.objects.get(user__username="anna").answer, "Rex")
+
+    def test_jsonl_import(self):
+        """JSON Lines rows are imported, a blank password is unusable and reported"""
+        path = self.write_file(".jsonl", '{"username": "dora", "password": "dorapass1"}\n'
+                                         '\n{"username": "eino"}\n')
+        out = StringIO()
+        call_command("import_users", path, "--workers", "1", stdout=out)
+        self.assertIn("1 without a password", out.getvalue())
+        self.assertTrue(User.objects.get(username="dora").check_password("dorapass1"))
+        self.assertFalse(User.objects.get(username="eino").has_usable_password())
+
+    def test_failed_answers_keep_users(self):
+        """Answers failing in the salon database are reported, the users stay"""
+        path = self.write_file(".csv", "username,password,question,answer\n"
+                                       "fanni,fannipass1,first_pet,Rex\n")
+        out, err = StringIO(), StringIO()
+        with mock.patch.object(Answer.objects, "bulk_create",
+                               side_effect=DatabaseError("disk full")):
+            call_command("import_users", path, "--workers", "1", stdout=out, stderr=err)
+        self.assertIn("Imported 1 users and 0 recovery answers", out.getvalue())
+        self.assertIn("1 answers failed", out.getvalue())
+        self.assertIn("fanni to fanni not saved: disk full", err.getvalue())
+        self.assertTrue(User.objects.filter(username="fanni").exists())
+
+    def test_json_array_import_in_small_chunks(self):
+        """A JSON array is decoded object by object across chunk boundaries"""
+        path = self.write_file(".json", '[\n  {"username": "gus", "password": "guspass12"},\n'
+                                        '  {"username": "gus", "password": "other1234"},\n'
+                                        '  {"username": "hilja", "email": "h@example.com",'
+                                        ' "question": "first_pet", "answer": "Rex"}\n]\n')
+        out, err = StringIO(), StringIO()
+        with mock.patch("pages.management.commands.import_users.JSON_CHUNK_SIZE", 7):
+            call_command("import_users", path, "--workers", "1", stdout=out, stderr=err)
+        self.assertIn("Imported 2 users and 1 recovery answers", out.getvalue())
+        self.assertIn("Line 3: duplicate username", err.getvalue())
+        self.assertTrue(User.objects.get(username="gus").check_password("guspass12"))
+        self.assertEqual(User.objects.get(username="hilja").email, "h@example.com")
+
+    def test_json_array_errors(self):
+        """Broken or non-object arrays are rejected with their line"""
+        for text, message in (('{"username": "ivo"}', "array of objects"),
+                              ('[{"username": "ivo"}\n{"username": "jan"}]', "Line 2: expected ,"),
+                              ('[{"username": "ivo"},\n"jan"]', "Line 2: JSON input needs"),
+                              ('[{"username": "ivo"', "Line 1: invalid JSON")):
+            path = self.write_file(".json", text)
+            with self.assertRaisesMessage(CommandError, message):
+                call_command("import_users", path, "--workers", "1", stdout=StringIO(),
+                             stderr=StringIO())
+
+    def test_jsonl_needs_objects(self):
+        """Other JSON values are rejected"""
+        path = self.write_file(".jsonl", '[{"username": "dora"}]\n')
+        with self.assertRaises(CommandError):
+            call_command("import_users", path, "--workers", "1", stdout=StringIO())
+
+
+class ImportSlotsCommandTests(TestCase):
+    """Tests for the import_slots command"""
+
+    def write_file(self, suffix, text):
+        """Write a temporary input file"""
+        handle = tempfile.NamedTemporaryFile("w", suffix=suffix, delete=False,
+                                             encoding="utf-8")
+        with handle:
+            handle.write(text)
+        self.addCleanup(os.remove, handle.name)
+        return handle.name
+
+    def test_csv_import_skips_duplicates_and_invalid_rows(self):
+        """Existing and repeated start dates are not inserted twice"""
+        start = (timezone.now() + timedelta(days=3)).replace(microsecond=0)
+        Appointment.objects.create(start_date=start)
+        rows = [start, start + timedelta(hours=1), start + timedelta(hours=1),
+                start + timedelta(hours=2)]
+        text = "start_date\n" + "\n".join(r.isoformat() for r in rows) + "\nnot a date\n"
+        path = self.write_file(".csv", text)
+
+        out = StringIO()
+        call_command("import_slots", path, "--batch-size=1", stdout=out, stderr=StringIO())
+
+        self.assertEqual(Appointment.objects.count(), 3)
+        self.assertIn("Imported 2 slots, 2 duplicates, 1 invalid", out.getvalue())
+
+    def test_out_of_range_date_is_invalid(self):
+        """A date-like value with month 13 is skipped, not a crash"""
+        start = (timezone.now() + timedelta(days=3)).replace(microsecond=0)
+        path = self.write_file(".csv", f"start_date\n2099-13-45T10:00\n{start.isoformat()}\n")
+
+        out, err = StringIO(), StringIO()
+        call_command("import_slots", path, stdout=out, stderr=err)
+
+        self.assertIn("Imported 1 slots, 0 duplicates, 1 invalid", out.getvalue())
+        self.assertIn("Line 2: invalid or past date", err.getvalue())
+
+    def test_slots_added_meanwhile_are_not_counted(self):
+        """Rows already in the table are neither reported nor added to counters"""
+        start = (timezone.now() + timedelta(days=3)).replace(microsecond=0)
+        Appointment.objects.create(start_date=start)
+        day = DailyAvailability.objects.get(day=timezone.localdate(start))
+        batch = [Appointment(start_date=start, end_date=start + timedelta(minutes=30)),
+                 Appointment(start_date=start + timedelta(hours=1),
+                             end_date=start + timedelta(hours=1, minutes=30))]
+
+        self.assertEqual(ImportSlotsCommand.flush(batch, None), 1)
+
+        day.refresh_from_db()
+        self.assertEqual(day.open_count, 2)
+        self.assertEqual(Appointment.objects.count(), 2)
+
+    def test_ics_import(self):
+        """VEVENT start times are imported in UTC and TZID forms"""
+        text = ("BEGIN:VCALENDAR\nBEGIN:VEVENT\nDTSTART:20991020T080000Z\nEND:VEVENT\n"
+                "BEGIN:VEVENT\nDTSTART;TZID=Europe/Helsinki:20991020T120000\nEND:VEVENT\n"
+                "END:VCALENDAR\n")
+        path = self.write_file(".ics", text)
+
+        call_command("import_slots", path, stdout=StringIO())
+
+        hours = sorted(a.start_date.hour for a in Appointment.objects.all())
+        self.assertEqual(hours, [8, 9])
+
+
+class CalendarFeedTests(TestCase):
+    """Tests for the per-user iCalendar feed"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username="tester", password="secret123")
+        self.appt = Appointment.objects.create(
+            start_date=timezone.now() + timedelta(days=1), user_id=self.user,
+            msg_text="Trim, please")
+        self.url = reverse("calendar_feed", args=[calendar_token(self.user)])
+
+    def test_feed_lists_user_appointments(self):
+        """Feed is streamed and contains the user's bookings"""
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        body = b"".join(response.streaming_content).decode()
+        self.assertIn(f"UID:appointment-{self.appt.id}@kumpulasalon", body)
+        self.assertIn(r"DESCRIPTION:Trim\, please", body)
+
+    def test_unchanged_feed_returns_not_modified(self):
+        """Polling with the previous ETag gives 304"""
+        etag = self.client.get(self.url)["ETag"]
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        Appointment.objects.create(start_date=timezone.now() + timedelta(days=2),
+                                   user_id=self.user)
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+    def test_tampered_token_is_rejected(self):
+        """Only signed tokens give access"""
+        response = self.client.get(reverse("calendar_feed", args=[f"{self.user.pk}:bad"]))
+        self.assertEqual(response.status_code, 404)
+
+
+# Slot event stream
+
+class SlotEventTests(TestCase):
+    """Tests for the slot availability change log and stream"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username="tester", password="secret123")
+
+    def test_saves_are_logged(self):
+        """Adding and booking a future slot writes change log rows"""
+        appt = Appointment.objects.create(start_date=timezone.now() + timedelta(days=1))
+        appt.user_id = self.user
+        appt.save()
+        Appointment.objects.create(start_date=timezone.now() - timedelta(days=1))
+
+        kinds = list(SlotEvent.objects.order_by("id").values_list("kind", "appointment_id"))
+        self.assertEqual(kinds, [(SlotEvent.ADDED, appt.id), (SlotEvent.BOOKED, appt.id)])
+
+    def test_logging_prunes_old_events(self):
+        """Saves prune the change log without a hub running"""
+        old = Appointment.objects.create(start_date=timezone.now() + timedelta(days=1))
+        SlotEvent.objects.update(created=timezone.now() - timedelta(days=1))
+        with mock.patch("pages.events.PRUNE_EVERY", 1):
+            Appointment.objects.create(start_date=timezone.now() + timedelta(days=2))
+        self.assertFalse(SlotEvent.objects.filter(appointment_id=old.id).exists())
+        self.assertEqual(SlotEvent.objects.count(), 1)
+
+    def test_imported_slots_are_logged(self):
+        """Slots inserted by import_slots reach the change log with their ids"""
+        start = (timezone.now() + timedelta(days=2)).replace(microsecond=0)
+        handle = tempfile.NamedTemporaryFile("w", suffix=".csv", delete=False, encoding="utf-8")
+        with handle:
+            handle.write(f"start_date\n{start.isoformat()}\n"
+                         f"{(start + timedelta(hours=1)).isoformat()}\n")
+        self.addCleanup(os.remove, handle.name)
+        call_command("import_slots", handle.name, stdout=StringIO())
+
+        logged = list(SlotEvent.objects.order_by("appointment_id")
+                      .values_list("kind", "appointment_id"))
+        self.assertEqual(logged, [(SlotEvent.ADDED, appt_id) for appt_id in
+                                  Appointment.objects.order_by("id").values_list("id", flat=True)])
+
+    def test_released_slots_are_logged(self):
+        """The admin release action logs the freed future slots"""
+        resource = Resource.objects.create(name="Stylist")
+        future = Appointment.objects.create(start_date=timezone.now() + timedelta(days=1),
+                                            user_id=self.user, resource=resource)
+        past = Appointment.objects.create(start_date=timezone.now() - timedelta(days=1),
+                                          user_id=self.user)
+        SlotEvent.objects.all().delete()
+        User.objects.create_superuser(username="admin", password="secret123")
+        self.client.login(username="admin", password="secret123")
+        self.client.post(reverse("admin:pages_appointment_changelist"), {
+            "action": "release_slots", "_selected_action": [future.id, past.id]})
+
+        event = SlotEvent.objects.get()
+        self.assertEqual((event.kind, event.appointment_id), (SlotEvent.ADDED, future.id))
+        self.assertIn(f'"resource": {resource.id}', event_payload(event))
+
+    async def test_hub_fans_out_new_events(self):
+        """Every subscribed queue receives the polled events"""
+        hub = SlotEventHub(poll_interval=0.01)
+        first, second = hub.subscribe(), hub.subscribe()
+        await asyncio.sleep(0.05)
+        appt = await Appointment.objects.acreate(start_date=timezone.now() + timedelta(days=1))
+
+        message = await asyncio.wait_for(first.get(), timeout=2)
+        self.assertIn("event: added", message)
+        self.assertIn(f'"id": {appt.id}', message)
+        self.assertEqual(await asyncio.wait_for(second.get(), timeout=2), message)
+        hub.unsubscribe(first)
+        hub.unsubscribe(second)
+        await asyncio.wait_for(hub.task, timeout=2)
+
+    def test_wsgi_fallback_replays_missed_events(self):
+        """Without ASGI the view answers once with events after Last-Event-ID"""
+        self.client.login(username="tester", password="secret123")
+        Appointment.objects.create(start_date=timezone.now() + timedelta(days=1))
+        event = SlotEvent.objects.get()
+
+        response = self.client.get(reverse("slot_events"), HTTP_LAST_EVENT_ID="0")
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        self.assertIn(event_payload(event), response.content.decode())
+
+
+class DailyAvailabilityTests(TestCase):
+    """Tests for the per-day open and booked counters"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username="tester", password="secret123")
+        self.start = timezone.now() + timedelta(days=2)
+        self.day = timezone.localdate(self.start)
+
+    def counts(self):
+        """Current counters of the test day"""
+        row = DailyAvailability.objects.get(day=self.day)
+        return row.open_count, row.booked_count
+
+    def test_create_book_and_delete_update_counters(self):
+        """Counters follow slot creation, booking and deletion"""
+        appt = Appointment.objects.create(start_date=self.start)
+        Appointment.objects.create(start_date=self.start + timedelta(minutes=30))
+        self.assertEqual(self.counts(), (2, 0))
+
+        self.client.login(username="tester", password="secret123")
+        self.client.post(reverse("booking"), {"start_date_id": appt.id, "note": "Hi"})
+        self.assertEqual(self.counts(), (1, 1))
+
+        Appointment.objects.get(id=appt.id).delete()
+        self.assertEqual(self.counts(), (1, 0))
+
+    def test_saving_deferred_instance_moves_counters(self):
+        """Booking a slot loaded with only() moves it from open to booked"""
+        appt = Appointment.objects.create(start_date=self.start)
+        slot = Appointment.objects.only("id").get(id=appt.id)
+        slot.user_id = self.user
+        slot.save()
+        self.assertEqual(self.counts(), (0, 1))
+
+        slot = Appointment.objects.only("id", "start_date").get(id=appt.id)
+        slot.msg_text = "note"
+        slot.save()
+        self.assertEqual(self.counts(), (0, 1))
+
+    def test_bulk_delete_adjusts_each_day_once(self):
+        """Deleting many slots is one DELETE plus one counter UPDATE per day"""
+        morning = timezone.make_aware(datetime(self.day.year, self.day.month, self.day.day, 9))
+        for minutes in range(0, 300, 30):
+            Appointment.objects.create(start_date=morning + timedelta(minutes=minutes),
+                                       user_id=self.user if minutes < 60 else None)
+            Appointment.objects.create(start_date=morning + timedelta(days=1, minutes=minutes))
+        Appointment.objects.create(start_date=morning + timedelta(days=2))
+
+        # Savepoint, per-day aggregate, DELETE, two UPDATEs, release
+        with self.assertNumQueries(6):
+            count = Appointment.objects.filter(
+                start_date__lt=morning + timedelta(days=2)).delete_counted()
+
+        self.assertEqual(count, 20)
+        self.assertEqual(self.counts(), (0, 0))
+        later = DailyAvailability.objects.get(day=self.day + timedelta(days=2))
+        self.assertEqual((later.open_count, later.booked_count), (1, 0))
+
+    def test_rebuild_fixes_drift(self):
+        """rebuild_availability reports and repairs wrong counters"""
+        Appointment.objects.create(start_date=self.start, user_id=self.user)
+        DailyAvailability.objects.filter(day=self.day).update(open_count=5)
+
+        out = StringIO()
+        call_command("rebuild_availability", "--check", stdout=out)
+        self.assertIn("1 drifted days found", out.getvalue())
+        self.assertEqual(self.counts(), (5, 1))
+
+        call_command("rebuild_availability", stdout=StringIO())
+        self.assertEqual(self.counts(), (0, 1))
+
+
+class SlotSearchTests(TestCase):
+    """Tests for the weekday and hour slot search"""
+
+    def setUp(self):
+        User.objects.create_user(username="tester", password="secret123")
+        self.client.login(username="tester", password="secret123")
+
+    def local_slot(self, year, month, day, hour):
+        """Create an open slot at a Helsinki local time"""
+        return Appointment.objects.create(
+            start_date=datetime(year, month, day, hour, tzinfo=SALON_TIMEZONE))
+
+    def test_generated_columns_use_local_time(self):
+        """Weekday and hour are computed in Europe/Helsinki time"""
+        appt = self.local_slot(2099, 1, 6, 0)  # Tuesday, 22:00 UTC on Monday
+        appt.refresh_from_db()
+        self.assertEqual((appt.local_weekday, appt.local_hour), (2, 0))
+
+    def test_search_filters_by_weekday_and_hours(self):
+        """Tuesday evenings exclude other days and hours"""
+        evening = self.local_slot(2099, 1, 6, 18)
+        self.local_slot(2099, 1, 6, 9)
+        self.local_slot(2099, 1, 7, 18)
+
+        response = self.client.get(reverse("slot_search"),
+                                   {"weekday": 2, "hour_from": 17, "hour_to": 21,
+                                    "date_from": "2099-01-01", "date_to": "2099-01-31"})
+        self.assertEqual([s["id"] for s in response.json()["slots"]], [evening.id])
+
+    def test_invalid_parameters_are_rejected(self):
+        """Bad hours give a 400 response"""
+        response = self.client.get(reverse("slot_search"), {"hour_from": 20, "hour_to": 10})
+        self.assertEqual(response.status_code, 400)
+
+
+class ResourceTests(TestCase):
+    """Tests for booking slots of several stylists and chairs"""
+
+    def setUp(self):
+        User.objects.create_user(username="tester", password="secret123")
+        self.client.login(username="tester", password="secret123")
+        self.start = timezone.now() + timedelta(days=1)
+
+    def create_resources(self, count, offset=0):
+        """Create resources each with one open slot at the same time"""
+        resources = []
+        for i in range(offset, offset + count):
+            resource = Resource.objects.create(name=f"Stylist {i}")
+            Appointment.objects.create(start_date=self.start, resource=resource)
+            resources.append(resource)
+        return resources
+
+    def test_same_time_is_unique_per_resource(self):
+        """A resource cannot have two slots starting at the same time"""
+        resource = self.create_resources(1)[0]
+        with self.assertRaises(IntegrityError):
+            Appointment.objects.create(start_date=self.start, resource=resource)
+
+    def test_free_slots_of_chosen_resources(self):
+        """free() returns open slots of the chosen resources in start order"""
+        first, second, _ = self.create_resources(3)
+        Appointment.objects.create(start_date=self.start - timedelta(hours=1), resource=second)
+        with self.assertNumQueries(1):
+            slots = [(a.start_date, a.resource.name)
+                     for a in Appointment.objects.free([first.id, second.id])[:2]]
+        self.assertEqual(slots, [(self.start - timedelta(hours=1), second.name),
+                                 (self.start, first.name)])
+
+    def test_free_skips_inactive_resources(self):
+        """Slots of a deactivated resource are not free, slots without one still are"""
+        active, inactive = self.create_resources(2)
+        Resource.objects.filter(id=inactive.id).update(active=False)
+        plain = Appointment.objects.create(start_date=self.start)
+        self.assertCountEqual([a.id for a in Appointment.objects.free()],
+                              [plain.id, active.appointment_set.get().id])
+        self.assertFalse(Appointment.objects.free([inactive.id]).exists())
+
+    def test_index_lists_at_most_free_slot_limit(self):
+        """The home page lists the first FREE_SLOT_LIMIT open slots"""
+        self.create_resources(3)
+        with mock.patch("pages.views.FREE_SLOT_LIMIT", 2):
+            response = self.client.get(reverse("index"))
+        self.assertEqual(len(response.context["available_appointments"]), 2)
+
+    def test_index_query_count_does_not_grow_with_resources(self):
+        """Booking page stays constant-query as resources are added"""
+        self.create_resources(2)
+        with CaptureQueriesContext(connection) as few:
+            self.client.get(reverse("index"))
+        self.create_resources(8, offset=2)
+        with CaptureQueriesContext(connection) as many:
+            response = self.client.get(reverse("index"))
+        self.assertEqual(len(response.context["available_appointments"]), 10)
+        self.assertEqual(len(few), len(many))
+
+
+class OverlapTests(TestCase):
+    """Tests for variable length appointments"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username="tester", password="secret123")
+        self.client.login(username="tester", password="secret123")
+        self.resource = Resource.objects.create(name="Anna")
+        self.start = (timezone.now() + timedelta(days=1)).replace(microsecond=0)
+
+    def slot(self, minutes_from_start, duration, user=None):
+        """Create a slot of the test resource"""
+        return Appointment.objects.create(
+            start_date=self.start + timedelta(minutes=minutes_from_start),
+            duration=timedelta(minutes=duration), resource=self.resource, user_id=user)
+
+    def test_end_date_follows_duration(self):
+        """end_date is start plus duration"""
+        appt = self.slot(0, 90)
+        self.assertEqual(appt.end_date, self.start + timedelta(minutes=90))
+
+    def test_overlapping_booking_is_rejected(self):
+        """A slot inside a booked colouring cannot be booked"""
+        self.slot(0, 90, user=User.objects.create_user(username="other"))
+        inside = self.slot(30, 30)
+        after = self.slot(90, 30)
+
+        self.client.post(reverse("booking"), {"start_date_id": inside.id, "note": "x"})
+        self.client.post(reverse("booking"), {"start_date_id": after.id, "note": "x"})
+
+        inside.refresh_from_db()
+        after.refresh_from_db()
+        self.assertIsNone(inside.user_id)
+        self.assertEqual(after.user_id, self.user)
+
+    def test_other_resources_do_not_overlap(self):
+        """Bookings of another stylist at the same time are allowed"""
+        other = Resource.objects.create(name="Beata")
+        Appointment.objects.create(start_date=self.start, duration=timedelta(minutes=90),
+                                   resource=other, user_id=self.user)
+        self.assertFalse(self.slot(0, 30).overlaps_booking())
+
+
+class IdempotencyTests(TestCase):
+    """Tests for replaying retried POSTs"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username="tester", password="secret123")
+        self.client.login(username="tester", password="secret123")
+
+    def test_booking_retry_is_replayed(self):
+        """A retried booking returns the stored response without touching Appointment"""
+        appt = Appointment.objects.create(start_date=timezone.now() + timedelta(days=1))
+        data = {"start_date_id": appt.id, "note": "first"}
+        first = self.client.post(reverse("booking"), data, HTTP_IDEMPOTENCY_KEY="abc")
+
+        with CaptureQueriesContext(connection) as queries:
+            retry = self.client.post(reverse("booking"), {**data, "note": "second"},
+                                     HTTP_IDEMPOTENCY_KEY="abc")
+        self.assertEqual(retry.status_code, first.status_code)
+        self.assertEqual(retry["Location"], first["Location"])
+        self.assertEqual(retry["Idempotent-Replayed"], "true")
+        self.assertFalse([q for q in queries if "pages_appointment" in q["sql"]])
+        appt.refresh_from_db()
+        self.assertEqual(appt.msg_text, "first")
+
+    def test_password_change_retry_does_not_rehash(self):
+        """The form field key replays the password change"""
+        data = {"username": "tester", "password1": "newStrongPass1",
+                "password2": "newStrongPass1", "idempotency_key": "k1"}
+        self.client.post(reverse("changepswd"), data)
+        password = User.objects.get(id=self.user.id).password
+
+        self.client.post(reverse("changepswd"), {**data, "password1": "otherPass12",
+                                                 "password2": "otherPass12"})
+        self.assertEqual(User.objects.get(id=self.user.id).password, password)
+
+    def test_replay_restores_messages(self):
+        """The retry shows the message of the first response again"""
+        appt = Appointment.objects.create(start_date=timezone.now() + timedelta(days=1))
+        data = {"start_date_id": appt.id, "note": "first"}
+        self.client.post(reverse("booking"), data, HTTP_IDEMPOTENCY_KEY="msg")
+        shown = self.client.get(reverse("index"))
+        self.assertEqual([str(m) for m in get_messages(shown.wsgi_request)],
+                         ["Booking successful!"])
+
+        retry = self.client.post(reverse("booking"), data, HTTP_IDEMPOTENCY_KEY="msg")
+        self.assertEqual(retry["Idempotent-Replayed"], "true")
+        shown = self.client.get(reverse("index"))
+        self.assertEqual([str(m) for m in get_messages(shown.wsgi_request)],
+                         ["Booking successful!"])
+
+    def test_abandoned_key_is_taken_over(self):
+        """A key left in progress past the lease lets the retry run the view"""
+        appt = Appointment.objects.create(start_date=timezone.now() + timedelta(days=1))
+        data = {"start_date_id": appt.id, "note": "retry"}
+        IdempotencyKey.objects.create(scope="booking", key="lost", owner=str(self.user.pk))
+
+        response = self.client.post(reverse("booking"), data, HTTP_IDEMPOTENCY_KEY="lost")
+        self.assertEqual(response.status_code, 409)
+
+        IdempotencyKey.objects.update(created=timezone.now() - IN_PROGRESS_LEASE * 2)
+        response = self.client.post(reverse("booking"), data, HTTP_IDEMPOTENCY_KEY="lost")
+        self.assertEqual(response.status_code, 302)
+        self.assertNotIn("Idempotent-Replayed", response)
+        appt.refresh_from_db()
+        self.assertEqual(appt.msg_text, "retry")
+        self.assertIsNotNone(IdempotencyKey.objects.get(key="lost").status_code)
+
+    def test_expired_keys_are_purged_once_per_interval(self):
+        """Expired keys are purged by the first keyed POST, not by every one"""
+        appt = Appointment.objects.create(start_date=timezone.now() + timedelta(days=1))
+        data = {"start_date_id": appt.id, "note": "purge"}
+        old = timezone.now() - IDEMPOTENCY_TTL * 2
+        IdempotencyKey.objects.create(scope="booking", key="old", owner="")
+        IdempotencyKey.objects.update(created=old)
+        with mock.patch.dict("pages.idempotency._last_purge", clear=True):
+            self.client.post(reverse("booking"), data, HTTP_IDEMPOTENCY_KEY="p1")
+            self.assertFalse(IdempotencyKey.objects.filter(key="old").exists())
+
+            IdempotencyKey.objects.create(scope="booking", key="old", owner="")
+            IdempotencyKey.objects.filter(key="old").update(created=old)
+            with CaptureQueriesContext(connection) as queries:
+                self.client.post(reverse("booking"), data, HTTP_IDEMPOTENCY_KEY="p2")
+        self.assertFalse([q for q in queries if q["sql"].startswith("DELETE")])
+        self.assertTrue(IdempotencyKey.objects.filter(key="old").exists())
+
+    def test_expired_key_is_not_replayed(self):
+        """A key older than the TTL runs the view again even before it is purged"""
+        appt = Appointment.objects.create(start_date=timezone.now() + timedelta(days=1))
+        IdempotencyKey.objects.create(scope="booking", key="stale", owner=str(self.user.pk),
+                                      status_code=200)
+        IdempotencyKey.objects.update(created=timezone.now() - IDEMPOTENCY_TTL * 2)
+        with mock.patch.dict("pages.idempotency._last_purge",
+                             {"default": timezone.now()}):
+            response = self.client.post(reverse("booking"),
+                                        {"start_date_id": appt.id, "note": "again"},
+                                        HTTP_IDEMPOTENCY_KEY="stale")
+        self.assertEqual(response.status_code, 302)
+        appt.refresh_from_db()
+        self.assertEqual(appt.msg_text, "again")
+
+    def test_form_renders_key(self):
+        """Booking form carries a fresh key"""
+        response = self.client.get(reverse("index"))
+        self.assertContains(response, 'name="idempotency_key"')
+
+
+class AuditLogTests(TestCase):
+    """Tests for structured audit logging"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username="tester", password="secret123")
+        self.client.login(username="tester", password="secret123")
+
+    def test_booking_is_audited(self):
+        """A booking logs its outcome and user"""
+        appt = Appointment.objects.create(start_date=timezone.now() + timedelta(days=1))
+        with self.assertLogs("pages.audit", level="INFO") as logs:
+            self.client.post(reverse("booking"), {"start_date_id": appt.id, "note": "x"})
+        record = logs.records[0]
+        self.assertEqual(record.audit["event"], "booking")
+        self.assertEqual(record.audit["user"], "tester")
+        self.assertEqual(record.audit["outcome"], "success")
+
+    def test_password_change_does_not_log_password(self):
+        """Password change is logged without the password"""
+        with self.assertLogs("pages.audit", level="INFO") as logs:
+            self.client.post(reverse("changepswd"), {
+                "username": "tester", "password1": "abc12345", "password2": "other"})
+        line = JsonFormatter().format(logs.records[0])
+        self.assertEqual(json.loads(line)["outcome"], "mismatch")
+        self.assertNotIn("abc12345", line)
+
+    def test_queued_handler_writes_json_lines(self):
+        """Records are written to the file by the listener thread"""
+        with tempfile.TemporaryDirectory() as directory:
+            handler = QueuedRotatingFileHandler(os.path.join(directory, "audit.log"))
+            handler.setFormatter(JsonFormatter())
+            logger = logging.getLogger("pages.tests.audit")
+            logger.addHandler(handler)
+            try:
+                logger.warning("hello", extra={"audit": {"event": "test"}})
+            finally:
+                logger.removeHandler(handler)
+                handler.close()
+            with open(os.path.join(directory, "audit.log"), encoding="utf-8") as log_file:
+                entry = json.loads(log_file.readline())
+        self.assertEqual((entry["event"], entry["message"]), ("test", "hello"))
+
+    def test_settings_handler_is_configurable(self):
+        """dictConfig builds the audit handler from its LOGGING entry"""
+        with tempfile.TemporaryDirectory() as directory:
+            entry = {**settings.LOGGING["handlers"]["audit_file"],
+                     "filename": os.path.join(directory, "audit.log")}
+            del entry["formatter"]
+            handler = logging.config.DictConfigurator({"version": 1}).configure_handler(entry)
+            handler.close()
+        self.assertIsInstance(handler, QueuedRotatingFileHandler)
+
+
+class RepeatedQueryMiddlewareTests(TestCase):
+    """Tests for the development N+1 query detector"""
+
+    def setUp(self):
+        self.admin = User.objects.create_superuser(username="admin", password="secret123")
+        for i in range(8):
+            Appointment.objects.create(start_date=timezone.now() + timedelta(days=1, hours=i),
+                                       user_id=User.objects.create_user(username=f"u{i}"))
+
+    def test_fingerprint_normalises_parameters(self):
+        """Literals and IN lists collapse to one shape"""
+        self.assertEqual(fingerprint("SELECT a FROM t WHERE id IN (%s, %s) AND n = 'x' LIMIT 21"),
+                         "SELECT a FROM t WHERE id IN (...) AND n = ? LIMIT ?")
+
+    @override_settings(DEBUG=True)
+    def test_repeated_template_query_is_reported(self):
+        """A lookup per row in a template is flagged with its template line"""
+        def view(request):
+            return render(request, "pages/appointments.html",
+                          {"appointments": Appointment.objects.order_by("start_date")})
+
+        middleware = RepeatedQueryMiddleware(view)
+        with self.assertLogs("pages.queries", level="WARNING"):
+            response = middleware(RequestFactory().get("/appointments/"))
+        self.assertIn("8x at pages/appointments.html:", response["X-Repeated-Queries"])
+
+    @override_settings(DEBUG=True)
+    def test_appointments_view_has_no_repeated_queries(self):
+        """The appointment list joins users"""
+        self.client.login(username="admin", password="secret123")
+        response = self.client.get(reverse("appointments"))
+        self.assertNotIn("X-Repeated-Queries", response)
+
+    def test_inactive_without_debug(self):
+        """Middleware is not used when DEBUG is off"""
+        with self.assertRaises(MiddlewareNotUsed):
+            RepeatedQueryMiddleware(lambda request: None)
+
+
+@override_settings(CONCURRENCY_LIMITS={"booking": 1}, CONCURRENCY_QUEUE_SIZE=0)
+class ConcurrencyLimitTests(TestCase):
+    """Tests for shedding load on write-heavy views"""
+
+    def setUp(self):
+        self.entered = threading.Event()
+        self.release = threading.Event()
+
+        def slow_view(request):
+            if request.method == "POST":
+                self.entered.set()
+                self.release.wait(5)
+            return render(request, "pages/question.html")
+
+        self.middleware = ConcurrencyLimitMiddleware(slow_view)
+
+    def hold_booking(self):
+        """Keeps one booking request in flight until release is set"""
+        worker = threading.Thread(
+            target=self.middleware, args=(RequestFactory().post(reverse("booking")),))
+        worker.start()
+        self.addCleanup(worker.join)
+        self.addCleanup(self.release.set)
+        self.entered.wait(5)
+
+    def test_excess_booking_is_shed(self):
+        """Request over the limit gets a fast 503 with Retry-After"""
+        self.hold_booking()
+        with self.assertLogs("pages.load", "WARNING"):
+            response = self.middleware(RequestFactory().post(reverse("booking")))
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response["Retry-After"], "2")
+
+    def test_read_views_are_not_limited(self):
+        """Index is served while bookings are at the limit"""
+        self.hold_booking()
+        response = self.middleware(RequestFactory().get(reverse("index")))
+        self.assertEqual(response.status_code, 200)
+
+    def test_queued_request_waits_for_free_slot(self):
+        """Waiting request gets in once the running one leaves"""
+        gate = Gate(limit=1, queue_size=1, timeout=5)
+        gate.enter()
+        threading.Timer(0.05, gate.leave).start()
+        self.assertTrue(gate.enter())
+
+    def test_queued_request_gives_up_after_timeout(self):
+        """Waiting request is turned away when no slot frees in time"""
+        gate = Gate(limit=1, queue_size=1, timeout=0.01)
+        gate.enter()
+        self.assertFalse(gate.enter())
+        self.assertEqual(gate.waiting, 0)
+
+    def test_inactive_without_limits(self):
+        """Middleware is not used when no limits are configured"""
+        with self.settings(CONCURRENCY_LIMITS={}):
+            with self.assertRaises(MiddlewareNotUsed):
+                ConcurrencyLimitMiddleware(lambda request: None)
+
+
+class HistoryTests(TestCase):
+    """Tests for the paginated booking history"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username="regular", password="secret123")
+        self.client.login(username="regular", password="secret123")
+        now = timezone.now()
+        self.past = [Appointment.objects.create(start_date=now - timedelta(days=day),
+                                                user_id=self.user, msg_text=f"past {day}")
+                     for day in range(1, 6)]
+        self.upcoming = Appointment.objects.create(start_date=now + timedelta(days=1),
+                                                   user_id=self.user)
+        old = Appointment.objects.create(start_date=now - timedelta(days=90), user_id=self.user)
+        ArchivedAppointment.from_appointment(old).save()
+        self.archived_id = old.id
+        old.delete()
+
+    def test_index_shows_upcoming_and_latest_past(self):
+        """Only a few past bookings are loaded on the home page"""
+        response = self.client.get(reverse("index"))
+        self.assertEqual(response.context["user_appointments"],
+                         [self.upcoming, *self.past[:views.RECENT_PAST_COUNT]])
+
+    def test_cursor_walks_live_and_archived_bookings(self):
+        """Pages follow each other without gaps into the archive"""
+        ids = []
+        url = reverse("history_json")
+        with mock.patch.object(views, "HISTORY_PAGE_SIZE", 2):
+            while url:
+                data = self.client.get(url).json()
+                ids += [row["id"] for row in data["appointments"]]
+                url = data["next"] and reverse("history_json") + "?after=" + data["next"]
+        self.assertEqual(ids, [self.upcoming.id, *(a.id for a in self.past), self.archived_id])
+
+    def test_history_page_size(self):
+        """History page links to the next one"""
+        page, cursor = views._history_page(self.user, size=4)  # pylint: disable=protected-access
+        self.assertEqual(len(page), 4)
+        response = self.client.get(reverse("history") + "?after=" + cursor)
+        self.assertEqual(response.context["appointments"][0], self.past[3])
+
+    def test_history_is_per_user(self):
+        """Other users' bookings are not listed"""
+        User.objects.create_user(username="other", password="secret123")
+        self.client.login(username="other", password="secret123")
+        self.assertEqual(self.client.get(reverse("history_json")).json()["appointments"], [])
+
+    def test_invalid_cursor(self):
+        """Malformed cursor is rejected"""
+        response = self.client.get(reverse("history_json") + "?after=abc")
+        self.assertEqual(response.status_code, 400)
+
+    def test_out_of_range_cursor(self):
+        """Cursor beyond the datetime range is rejected, not a server error"""
+        for cursor in ("99999999999999999999-1", "999999999999999999-1"):
+            response = self.client.get(reverse("history_json") + "?after=" + cursor)
+            self.assertEqual(response.status_code, 400)
+            response = self.client.get(reverse("history") + "?after=" + cursor)
+            self.assertEqual(response.status_code, 200)
+
+
+class DashboardTests(TestCase):
+    """Tests for the staff utilization dashboard"""
+
+    def setUp(self):
+        dashboard.clear()
+        self.addCleanup(dashboard.clear)
+        self.staff = User.objects.create_superuser(username="admin", password="secret123")
+        now = timezone.now()
+        Appointment.objects.create(start_date=now - timedelta(days=40), user_id=self.staff)
+        Appointment.objects.create(start_date=now - timedelta(days=40, hours=1))
+        Appointment.objects.create(start_date=now + timedelta(days=3), user_id=self.staff)
+
+    def test_panels_count_booked_and_open(self):
+        """Monthly panel adds up history and recent slots"""
+        stats = dashboard.utilization()
+        self.assertEqual(sum(row["booked"] for row in stats["monthly"]), 2)
+        self.assertEqual(sum(row["open"] for row in stats["monthly"]), 1)
+        self.assertEqual(sum(row["count"] for row in stats["lead"]), 2)
+        self.assertEqual(sum(row["count"] for row in stats["peak"]), 2)
+
+    def test_archived_appointments_are_counted(self):
+        """Archiving moves slots out of Appointment without changing the panels"""
+        before = dashboard.utilization()
+        call_command("archive_appointments", "--days", "30", "--sleep", "0", stdout=StringIO())
+        self.assertEqual(ArchivedAppointment.objects.count(), 2)
+        with CaptureQueriesContext(connection) as queries:
+            after = dashboard.utilization()
+        self.assertTrue([q for q in queries if "pages_archivedappointment" in q["sql"]])
+        self.assertEqual(after, before)
+
+    def test_deleting_past_slots_refreshes_panels(self):
+        """The admin action drops the cached panels holding the deleted slots"""
+        dashboard.utilization()
+        self.client.login(username="admin", password="secret123")
+        self.client.post(reverse("admin:pages_appointment_changelist"), {
+            "action": "delete_past_slots",
+            "_selected_action": list(Appointment.objects.values_list("id", flat=True)),
+        })
+        stats = dashboard.utilization()
+        self.assertEqual(sum(row["booked"] for row in stats["monthly"]), 1)
+        self.assertEqual(sum(row["open"] for row in stats["monthly"]), 0)
+
+    def test_deleting_a_past_slot_refreshes_panels(self):
+        """Signals drop the cached history when a slot before today is deleted"""
+        dashboard.utilization()
+        Appointment.objects.filter(user_id__isnull=True).get().delete()
+        stats = dashboard.utilization()
+        self.assertEqual(sum(row["open"] for row in stats["monthly"]), 0)
+
+    def test_releasing_past_slots_refreshes_panels(self):
+        """The release action drops the cached history it changes"""
+        dashboard.utilization()
+        self.client.login(username="admin", password="secret123")
+        self.client.post(reverse("admin:pages_appointment_changelist"), {
+            "action": "release_slots",
+            "_selected_action": list(Appointment.objects.values_list("id", flat=True)),
+        })
+        stats = dashboard.utilization()
+        self.assertEqual(sum(row["booked"] for row in stats["monthly"]), 0)
+
+    def test_history_is_rebuilt_after_the_timeout(self):
+        """An extended history is queried in full again once it is a week old"""
+        boundary = timezone.now() - timedelta(days=20)
+        dashboard.history(boundary - timedelta(days=10))
+        # A change that sends no signals, like raw SQL
+        Appointment.objects.filter(start_date__lt=boundary).update(user_id=None)
+        stats = dashboard.history(boundary)
+        self.assertEqual(sum(c[0] for c in stats["monthly"].values()), 0)
+
+    def test_cached_dashboard_runs_no_appointment_queries(self):
+        """Second load is served from the cache"""
+        self.client.login(username="admin", password="secret123")
+        self.client.get(reverse("dashboard"))
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse("dashboard"))
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse([q for q in queries if "pages_appointment" in q["sql"]])
+
+    def test_history_is_extended_incrementally(self):
+        """A later boundary only queries the days since the cached one"""
+        boundary = timezone.now() - timedelta(days=10)
+        dashboard.history(boundary - timedelta(days=1))
+        with CaptureQueriesContext(connection) as queries:
+            stats = dashboard.history(boundary)
+        reads = [q["sql"] for q in queries if "appointment" in q["sql"]]
+        self.assertTrue(reads)
+        self.assertTrue(all('"start_date" >=' in sql for sql in reads))
+        self.assertEqual(sum(c[0] for c in stats["monthly"].values()), 1)
+
+    def test_customers_cannot_see_dashboard(self):
+        """Only staff can open the dashboard"""
+        User.objects.create_user(username="customer", password="secret123")
+        self.client.login(username="customer", password="secret123")
+        response = self.client.get(reverse("dashboard"))
+        self.assertEqual(response.status_code, 302)
+
+
+@override_settings(SALONS={"kumpula": "default", "viikki": "salon_viikki"})
+class TenancyTests(TestCase):
+    """Tests for routing salons to their own databases"""
+
+    @override_settings(ALLOWED_HOSTS=[".example.com"])
+    def test_salon_from_subdomain(self):
+        """Subdomain picks the salon without a URL prefix"""
+        request = RequestFactory().get("/booking/", HTTP_HOST="viikki.example.com")
+        self.assertEqual(salon_from_request(request), ("viikki", ""))
+
+    def test_salon_from_path_prefix(self):
+        """First path segment picks the salon and becomes the prefix"""
+        request = RequestFactory().get("/viikki/booking/")
+        self.assertEqual(salon_from_request(request), ("viikki", "/viikki"))
+
+    def test_unknown_salon_falls_back_to_default(self):
+        """Requests naming no salon use the first one"""
+        request = RequestFactory().get("/booking/")
+        self.assertEqual(salon_from_request(request), ("kumpula", ""))
+
+    def test_router_sends_salon_data_to_active_salon(self):
+        """Booking data follows the salon, users stay in default"""
+        router = SalonRouter()
+        with use_salon("viikki"):
+            self.assertEqual(router.db_for_write(Appointment), "salon_viikki")
+            self.assertEqual(router.db_for_read(User), "default")
+        self.assertEqual(router.db_for_read(Appointment), "default")
+
+    def test_router_migrates_shared_apps_only_in_default(self):
+        """Salon databases get only the salon tables"""
+        router = SalonRouter()
+        self.assertTrue(router.allow_migrate("salon_viikki", "pages"))
+        self.assertFalse(router.allow_migrate("salon_viikki", "auth"))
+        self.assertTrue(router.allow_migrate("default", "auth"))
+
+    def test_all_salons_runs_command_per_salon(self):
+        """Each salon gets its own run of the command"""
+        out = StringIO()
+        with self.assertRaises(KeyError):
+            with use_salon("herttoniemi"):
+                pass
+        call_command("all_salons", "check", stdout=out)
+        self.assertIn("Salon kumpula", out.getvalue())
+        self.assertIn("Salon viikki", out.getvalue())
+
+
+class SecondSalonMixin:
+    """Adds a viikki salon with a SQLite file of its own for the test class
+
+    The database and the salon exist only while the class runs, the settings
+    stay as deployed.
+    """
+    salon, alias = "viikki", "salon_viikki"
+    migrate_salon = True
+
+    @classmethod
+    def setUpClass(cls):
+        directory = tempfile.TemporaryDirectory()
+        cls.addClassCleanup(directory.cleanup)
+        connections.settings[cls.alias] = {
+            **connections.settings["default"],
+            "NAME": os.path.join(directory.name, f"{cls.alias}.sqlite3")}
+        cls.addClassCleanup(cls.remove_salon_database)
+        salons = override_settings(SALONS={**settings.SALONS, cls.salon: cls.alias})
+        salons.enable()
+        cls.addClassCleanup(salons.disable)
+        if cls.migrate_salon:
+            with use_salon(cls.salon):
+                call_command("migrate", database=cls.alias, verbosity=0)
+        # Set here, the runner checks the databases of every test before this runs
+        cls.databases = {"default", cls.alias}
+        super().setUpClass()
+
+    @classmethod
+    def remove_salon_database(cls):
+        """Closes and forgets the salon's connection"""
+        connections[cls.alias].close()
+        del connections[cls.alias]
+        del connections.settings[cls.alias]
+
+
+class SalonDatabaseTests(SecondSalonMixin, TestCase):
+    """Tests booking in a second salon with a database of its own"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username="tester", password="secret123")
+        self.client.login(username="tester", password="secret123")
+        self.start = timezone.now() + timedelta(days=1)
+        self.home_slot = Appointment.objects.create(start_date=self.start)
+        with use_salon("viikki"):
+            self.slot = Appointment.objects.create(start_date=self.start)
+
+    def test_booking_stays_in_the_salon_database(self):
+        """A booking under the salon prefix touches only that salon's tables"""
+        response = self.client.post(f"/viikki{reverse('booking')}",
+                                    {"start_date_id": self.slot.id, "note": "viikki"})
+        self.assertEqual(response.status_code, 302)
+
+        booked = Appointment.objects.using("salon_viikki").get(id=self.slot.id)
+        self.assertEqual(booked.user_id_id, self.user.id)
+        self.assertEqual(DailyAvailability.objects.using("salon_viikki")
+                         .get(day=timezone.localdate(self.start)).booked_count, 1)
+        self.home_slot.refresh_from_db()
+        self.assertIsNone(self.home_slot.user_id)
+        self.assertEqual(DailyAvailability.objects.using("default")
+                         .get(day=timezone.localdate(self.start)).booked_count, 0)
+
+    def test_salon_atomic_rolls_back_the_salon_database(self):
+        """salon_atomic wraps the active salon's database, not default"""
+        @salon_atomic
+        def book_and_fail():
+            self.assertTrue(connections["salon_viikki"].in_atomic_block)
+            Appointment.objects.filter(id=self.slot.id).update(msg_text="lost")
+            raise ValueError
+
+        with use_salon("viikki"), self.assertRaises(ValueError):
+            book_and_fail()
+        self.assertNotEqual(Appointment.objects.using("salon_viikki")
+                            .get(id=self.slot.id).msg_text, "lost")
+
+    def test_user_delete_cascades_into_every_salon(self):
+        """Deleting a user removes their bookings and answers in the other salon"""
+        with use_salon("viikki"):
+            Appointment.objects.filter(id=self.slot.id).update(user_id=self.user)
+            Answer.objects.create(user=self.user, answer="Smith",
+                                  recovery_question=Question.objects.get(text="mother_maiden"))
+        other = Appointment.objects.using("salon_viikki").create(
+            start_date=self.start + timedelta(hours=1))
+
+        self.user.delete()
+        self.assertEqual(list(Appointment.objects.using("salon_viikki")
+                              .values_list("id", flat=True)), [other.id])
+        self.assertFalse(Answer.objects.using("salon_viikki").exists())
+        self.assertTrue(Appointment.objects.using("default").filter(id=self.home_slot.id)
+                        .exists())
+
+
+class SalonMigrationTests(SecondSalonMixin, TransactionTestCase):
+    """Tests migrating a new salon database, outside a transaction so SQLite can alter tables"""
+    migrate_salon = False
+
+    def test_data_migrations_fill_the_migrated_salon(self):
+        """Data migrations read and write the salon being migrated, not default"""
+        start = timezone.now() + timedelta(days=1)
+        for hour in range(3):
+            Appointment.objects.create(start_date=start + timedelta(hours=hour))
+        counters = list(DailyAvailability.objects.values_list("day", "open_count"))
+
+        call_command("all_salons", "migrate", "--verbosity=0", stdout=StringIO())
+
+        self.assertEqual(list(DailyAvailability.objects.values_list("day", "open_count")),
+                         counters)
+        self.assertFalse(DailyAvailability.objects.using(self.alias).exists())
+        self.assertFalse(Appointment.objects.using(self.alias).exists())
+        self.assertEqual(Question.objects.using(self.alias).count(), 3)
@@ -21,8 +21,14 @@ urlpatterns = [
     path("booking/", views.booking, name="booking"),
     path("forgot/", views.forgot, name="forgot"),
     path("appointments/", views.appointments, name="appointments"),
+    path("dashboard/", views.dashboard, name="dashboard"),
     path("question/", views.question, name="question"),
     path("changepswd/", views.changepswd, name="changepswd"),
+    path("calendar/<str:token>.ics", views.calendar_feed, name="calendar_feed"),
+    path("events/", views.slot_events, name="slot_events"),
+    path("slots/search/", views.slot_search, name="slot_search"),
+    path("history/", views.history, name="history"),
+    path("history/json/", views.history_json, name="history_json"),
 
     path('password_reset/', auth_views.PasswordResetView.as_view(),
      name='password_reset'),
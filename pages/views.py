@@ -1,43 +1,296 @@
 """Modules for views..."""
+import asyncio
 import re
+from datetime import datetime, time, timedelta, timezone as dt_timezone
+from asgiref.sync import sync_to_async
 from django.contrib.admin.views.decorators import staff_member_required # pylint: disable=unused-import
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth import get_user_model
 from django.contrib import messages
-from django.db import transaction
+from django.core.handlers.asgi import ASGIRequest
+from django.db.models import Count, Max, Q
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
 from django.shortcuts import render, redirect
+from django.urls import reverse
 from django.utils import timezone
+from django.utils.dateparse import parse_date
 from django.views.decorators.csrf import csrf_exempt # pylint: disable=unused-import
-from .models import Appointment, Question, Answer
+from django.views.decorators.http import condition, require_safe
+from . import dashboard as utilization_dashboard
+from .audit import audit
+from .events import event_payload, events_after, get_hub, latest_event_id
+from .feeds import calendar_token, ics_lines, user_id_from_token
+from .idempotency import idempotent
+from .models import (Appointment, ArchivedAppointment, DailyAvailability, Question, Answer,
+                     Resource, SALON_TIMEZONE)
+from .tenancy import salon_atomic, salon_db
 
 User = get_user_model()
 
+# Past appointments shown on the home page, older ones are in the history
+RECENT_PAST_COUNT = 3
+# Open slots listed on the home page, the slot search finds the rest
+FREE_SLOT_LIMIT = 200
+# Appointments per history page
+HISTORY_PAGE_SIZE = 20
+# Fields shown in the booking lists
+HISTORY_FIELDS = ('id', 'start_date', 'msg_text', 'resource__name')
+
+EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+
+def _history_cursor(appointment):
+    """Returns the cursor continuing after the appointment"""
+    micros = (appointment.start_date - EPOCH) // timedelta(microseconds=1)
+    return f"{micros}-{appointment.id}"
+
+def _parse_history_cursor(cursor):
+    """Returns (start_date, id) of the cursor, raises ValueError if invalid"""
+    micros, pk = cursor.split("-")
+    try:
+        return EPOCH + timedelta(microseconds=int(micros)), int(pk)
+    except OverflowError as error:
+        raise ValueError("cursor out of range") from error
+
+def _history_page(user, cursor=None, size=None):
+    """Returns a page of the user's bookings, newest first, and the next cursor
+
+    Live and archived appointments share their ids, so both tables are read
+    with the same (start_date, id) keyset and merged. Each query reads at most
+    one page from the (user, start_date) index however long the history is.
+    """
+    size = size or HISTORY_PAGE_SIZE
+    pages = []
+    for model in (Appointment, ArchivedAppointment):
+        rows = ( model.objects
+                .filter(user_id=user.id)
+                .select_related('resource')
+                .only(*HISTORY_FIELDS)
+                .order_by('-start_date', '-id') )
+        if cursor is not None:
+            start, pk = cursor
+            # The plain start_date bound lets the index range scan do the work
+            rows = rows.filter(Q(start_date__lt=start) | Q(start_date=start, id__lt=pk),
+                               start_date__lte=start)
+        pages.extend(rows[:size + 1])
+    pages.sort(key=lambda row: (row.start_date, row.id), reverse=True)
+    page = pages[:size]
+    next_cursor = _history_cursor(page[-1]) if len(pages) > size else None
+    return page, next_cursor
+
 @login_required
 def index(request):
     """Home page of booking"""
-    # Future appointments (not past ones)
-    available_appointments = ( Appointment.objects
-                              .filter(start_date__gte=timezone.now(),
-                              user_id__isnull=True)
-                              .order_by('start_date'))
-
-    # User's booked appointments
-    user_appointments = ( Appointment.objects
-                         .filter(user_id=request.user.id)
-                         .order_by('-start_date') )
+    # Future appointments (not past ones), with every chosen resource in one query
+    resources = list(Resource.objects.filter(active=True).order_by('name'))
+    chosen_resources = [int(pk) for pk in request.GET.getlist('resource') if pk.isdigit()]
+    available_appointments = Appointment.objects.free(chosen_resources, FREE_SLOT_LIMIT)
+
+    # User's upcoming appointments and the latest few past ones, the rest is in history
+    now = timezone.now()
+    bookings = ( Appointment.objects
+                .filter(user_id=request.user.id)
+                .select_related('resource')
+                .only(*HISTORY_FIELDS)
+                .order_by('-start_date', '-id') )
+    user_appointments = [*bookings.filter(start_date__gte=now),
+                         *bookings.filter(start_date__lt=now)[:RECENT_PAST_COUNT]]
+
+    # Free slots per day for the coming week, read from the counter table
+    today = timezone.localdate()
+    free_per_day = ( DailyAvailability.objects
+                    .filter(day__gte=today, day__lt=today + timedelta(days=7),
+                            open_count__gt=0)
+                    .order_by('day') )
 
     context = {
         "available_appointments": available_appointments,
+        "resources": resources,
+        "chosen_resources": chosen_resources,
+        "resource_names": {resource.id: resource.name for resource in resources},
         "user_appointments": user_appointments,
-        "now": timezone.now()
+        "free_per_day": free_per_day,
+        "calendar_url": request.build_absolute_uri(
+            reverse('calendar_feed', args=[calendar_token(request.user)])),
+        "now": now
     }
     return render(request, "pages/index.html", context)
 
+# Maximum number of slots returned by the slot search
+SLOT_SEARCH_LIMIT = 100
+
+def _slot_search_filters(params):
+    """Returns queryset filters for the search parameters, raises ValueError if invalid"""
+    filters = {}
+    weekdays = [int(day) for day in params.getlist('weekday')]
+    if any(day < 1 or day > 7 for day in weekdays):
+        raise ValueError("weekday must be between 1 (Monday) and 7 (Sunday)")
+    if weekdays:
+        filters['local_weekday__in'] = weekdays
+
+    hour_from = int(params.get('hour_from', 0))
+    hour_to = int(params.get('hour_to', 24))
+    if not 0 <= hour_from < hour_to <= 24:
+        raise ValueError("hours must satisfy 0 <= hour_from < hour_to <= 24")
+    if hour_from > 0:
+        filters['local_hour__gte'] = hour_from
+    if hour_to < 24:
+        filters['local_hour__lt'] = hour_to
+
+    for name, lookup, offset in (('date_from', 'start_date__gte', 0),
+                                 ('date_to', 'start_date__lt', 1)):
+        if params.get(name):
+            day = parse_date(params[name])
+            if day is None:
+                raise ValueError(f"{name} must be a date like 2025-09-30")
+            filters[lookup] = datetime.combine(day + timedelta(days=offset), time(),
+                                               tzinfo=SALON_TIMEZONE)
+    return filters
+
+@login_required
+def slot_search(request):
+    """Open slots by weekday, hour range and date range as JSON"""
+    try:
+        filters = _slot_search_filters(request.GET)
+    except ValueError as error:
+        return JsonResponse({"error": str(error)}, status=400)
+
+    # Weekday and hour are indexed generated columns in salon local time
+    resources = [int(pk) for pk in request.GET.getlist('resource') if pk.isdigit()]
+    slots = ( Appointment.objects
+             .free(resources)
+             .filter(**filters)
+             .values('id', 'start_date', 'resource__name')[:SLOT_SEARCH_LIMIT] )
+    return JsonResponse({"slots": [
+        {"id": slot['id'], "start": slot['start_date'].isoformat(),
+         "resource": slot['resource__name']} for slot in slots
+    ]})
+
+@login_required
+def history(request):
+    """All of the user's bookings, a page at a time"""
+    try:
+        cursor = _parse_history_cursor(request.GET['after']) if 'after' in request.GET else None
+    except ValueError:
+        cursor = None
+    page, next_cursor = _history_page(request.user, cursor)
+    context = {
+        "appointments": page,
+        "next_cursor": next_cursor,
+        "now": timezone.now(),
+    }
+    return render(request, "pages/history.html", context)
+
 @login_required
+def history_json(request):
+    """Page of the user's bookings as JSON, follow "next" for the following page"""
+    try:
+        cursor = _parse_history_cursor(request.GET['after']) if 'after' in request.GET else None
+    except ValueError:
+        return JsonResponse({"error": "invalid cursor"}, status=400)
+    page, next_cursor = _history_page(request.user, cursor)
+    return JsonResponse({
+        "appointments": [
+            {"id": row.id, "start": row.start_date.isoformat(),
+             "resource": row.resource.name if row.resource else None,
+             "note": row.msg_text,
+             "archived": isinstance(row, ArchivedAppointment)} for row in page
+        ],
+        "next": next_cursor,
+    })
+
+def _calendar_state(request, token):
+    """Returns the feed owner and the latest booking, computed once per request"""
+    # pylint: disable=protected-access
+    if not hasattr(request, '_calendar_state'):
+        user_pk = user_id_from_token(token)
+        state = None
+        if user_pk is not None:
+            state = ( Appointment.objects
+                     .filter(user_id=user_pk)
+                     .aggregate(latest=Max('book_date'), count=Count('id')) )
+        request._calendar_state = (user_pk, state)
+    return request._calendar_state
+
+def _calendar_etag(request, token):
+    """ETag changes when a booking is added, changed or removed"""
+    user_pk, state = _calendar_state(request, token)
+    if state is None:
+        return None
+    latest = state['latest'].timestamp() if state['latest'] else 0
+    return f"{user_pk}-{state['count']}-{latest}"
+
+def _calendar_last_modified(request, token):
+    """Last-Modified is the latest book_date of the user"""
+    _, state = _calendar_state(request, token)
+    return state['latest'] if state else None
+
+@require_safe
+@condition(etag_func=_calendar_etag, last_modified_func=_calendar_last_modified)
+def calendar_feed(request, token):
+    """Streams the user's appointments as an iCalendar feed"""
+    user_pk = user_id_from_token(token)
+    if user_pk is None:
+        raise Http404("Unknown calendar")
+
+    # The stream is read after the salon middleware returns, so pin the database
+    user_appointments = ( Appointment.objects
+                         .using(salon_db())
+                         .filter(user_id=user_pk)
+                         .only('id', 'start_date', 'end_date', 'book_date', 'msg_text')
+                         .order_by('start_date')
+                         .iterator(chunk_size=200) )
+    return StreamingHttpResponse(ics_lines(user_appointments),
+                                 content_type="text/calendar; charset=utf-8")
+
+# Seconds between keepalive comments on an idle event stream
+EVENT_KEEPALIVE = 15
+
+async def _slot_event_stream(last_id, using):
+    """Yields missed events, then live events from the hub until dropped"""
+    hub = get_hub(using)
+    queue = hub.subscribe()
+    try:
+        yield "retry: 3000\n\n"
+        if last_id is not None:
+            for event in await sync_to_async(events_after)(last_id, using):
+                yield event_payload(event)
+        while hub.is_subscribed(queue):
+            try:
+                yield await asyncio.wait_for(queue.get(), timeout=EVENT_KEEPALIVE)
+            except asyncio.TimeoutError:
+                yield ": keepalive\n\n"
+    finally:
+        hub.unsubscribe(queue)
+
+@login_required
+async def slot_events(request):
+    """Server-Sent Events stream of slots being added and booked"""
+    last_id = request.headers.get('Last-Event-ID')
+    last_id = int(last_id) if last_id and last_id.isdigit() else None
+    using = salon_db()
+
+    if not isinstance(request, ASGIRequest):
+        # A WSGI worker cannot hold the stream open, so answer once and let
+        # the browser reconnect after the retry delay
+        if last_id is None:
+            body = f"retry: 5000\nid: {await sync_to_async(latest_event_id)(using)}\n\n"
+        else:
+            events = await sync_to_async(events_after)(last_id, using)
+            body = "retry: 5000\n\n" + "".join(event_payload(e) for e in events)
+        return HttpResponse(body, content_type="text/event-stream")
+
+    response = StreamingHttpResponse(_slot_event_stream(last_id, using),
+                                     content_type="text/event-stream")
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+@login_required
+@idempotent
 # SECURITY FLAW 1: CSRF
 # Fix by commenting out # the line below
 @csrf_exempt
-@transaction.atomic
+@salon_atomic
 def booking(request):
     """Booking form handling"""
     if request.method == 'POST':
@@ -49,6 +302,15 @@ def booking(request):
         if booked_time.start_date < timezone.now():
             messages.error(request, "You cannot book a time in the past.",
                             extra_tags="booking")
+            audit(request, "booking", appointment=booked_time.id, outcome="past")
+            return redirect('index')
+
+        # Check that the resource is not booked for an overlapping time,
+        # inside this transaction so the check and the save go together
+        if booked_time.overlaps_booking():
+            messages.error(request, "This time overlaps another booking.",
+                            extra_tags="booking")
+            audit(request, "booking", appointment=booked_time.id, outcome="overlap")
             return redirect('index')
 
         note = request.POST.get('note')
@@ -66,6 +328,7 @@ def booking(request):
             booked_time.save()
             # Add success message
             messages.success(request, "Booking successful!", extra_tags="booking")
+            audit(request, "booking", appointment=booked_time.id, outcome="success")
     return redirect('index')
 
 
@@ -75,13 +338,23 @@ def booking(request):
 def appointments(request):
     """Appointment list view"""
     # All appointments (not past ones)
-    all_appointments = Appointment.objects.all().order_by('start_date')
+    all_appointments = ( Appointment.objects
+                        .select_related('user_id', 'resource')
+                        .order_by('start_date') )
 
     context = {
         "appointments": all_appointments,
     }
     return render(request, "pages/appointments.html", context)
 
+@staff_member_required
+def dashboard(request):
+    """Utilization dashboard for staff"""
+    if request.GET.get('refresh') == '1':
+        utilization_dashboard.clear()
+    context = utilization_dashboard.utilization()
+    return render(request, "pages/dashboard.html", context)
+
 # SECURITY FLAW 5: Security Misconfiguration:
 # Fix by disabling entire funtion and revert to built-in workflow
 
@@ -140,10 +413,12 @@ def forgot(request):
         if not re.match(r'^[\w\s.,!?-]*$', answer_text):
             messages.error(request, "Answer contains invalid characters!",
                             extra_tags="answer_check")
+            audit(request, "recovery_answer", username=username, outcome="invalid_answer")
             return redirect('forgot')
         if not re.match(r'^[\w\s.,!?-]*$', username):
             messages.error(request, "Username contains invalid characters!",
                             extra_tags="answer_check")
+            audit(request, "recovery_answer", username=username, outcome="invalid_username")
             return redirect('forgot')
 
         try:
@@ -152,6 +427,7 @@ def forgot(request):
         except (User.DoesNotExist, Question.DoesNotExist):
             messages.error(request, "Invalid username or question!",
                             extra_tags="answer_check")
+            audit(request, "recovery_answer", username=username, outcome="unknown")
             return redirect('forgot')
 
         exists = Answer.objects.filter(
@@ -160,6 +436,8 @@ def forgot(request):
             answer=answer_text
         ).exists()
 
+        audit(request, "recovery_answer", username=username, question=question_check.id,
+              outcome="correct" if exists else "wrong")
         if exists:
             # Add success message
             messages.success(request, "Recovery question was answered correctly!",
@@ -186,6 +464,7 @@ def forgot(request):
 
 # SECURITY FLAW 4: Identification and Authentication Failures:
 # Second option for fix is to disable entire function and revert to built-in workflow
+@idempotent
 def changepswd(request):
     """Custom made unsecure view for password change"""
     if request.method == 'POST':
@@ -197,14 +476,15 @@ def changepswd(request):
             user = User.objects.get(username=username)
             context = {"user" : user}
 
-            print("USEr", username, " PSW;", pswd1, username==pswd1)
             # Basic password checks
             if pswd1 != pswd2:
                 messages.error(request, "Passwords do not match!", extra_tags="pswd_check")
+                audit(request, "password_change", username=username, outcome="mismatch")
                 return render(request, "pages/changepswd.html", context)
             if len(pswd1) < 8:
                 messages.error(request, "Password must be at least 8 characters long.",
                                 extra_tags="pswd_check")
+                audit(request, "password_change", username=username, outcome="too_short")
                 return render(request, "pages/changepswd.html", context)
 # SECURITY FLAW 4: Identification and Authentication Failures:
 # First option for fix is removing comments from the following lines,
@@ -237,8 +517,10 @@ def changepswd(request):
         except User.DoesNotExist:
             # Add error message
             messages.error(request, "Check user!", extra_tags="pswd_check")
+            audit(request, "password_change", username=username, outcome="unknown_user")
             return redirect('changepswd')
 
+        audit(request, "password_change", username=username, outcome="success")
         # Add success message
         messages.success(request, "Password updated successfully!", extra_tags="pswd")
         return redirect('index')